@@ -1,9 +1,14 @@
 import sqlite3
+import threading
 
+from contextlib import contextmanager
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, select, insert
+from sqlalchemy.orm import relationship
+from sqlalchemy import create_engine, select, insert, update, delete, event, func, text, or_, Index, UniqueConstraint, ForeignKeyConstraint
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.types import TypeDecorator, TEXT
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timedelta, timezone
@@ -29,6 +34,33 @@ Base = declarative_base()
 def get_next_occurrence_for_txn(txn):
 	return rrule.rrulestr(rrule_for_txn(txn)).after(txn.previous_occurrence)
 
+# A new recurring transaction, not yet added to the DB. `recurring_event` may be a
+# RecurringEvent or its RFC rule, and `dtstart` is the rule's start, if it has one. Unless
+# given, the previous occurrence is now, or the start if that's sooner, so the first
+# transaction is created at the rule's first occurrence after it.
+def new_recurring_transaction(description, amount_decimal, category, recurring_event, dtstart, previous_occurrence=None, notes=None):
+	now = datetime.now()
+	return RecurringTransaction(
+		description=description,
+		amount=str(amount_decimal),
+		category=category,
+		dedupe_string=token_hex(8),
+		recurring_event=recurring_event,
+		previous_occurrence=previous_occurrence or (now if dtstart is None else min(now, dtstart)),
+		notes=notes
+	)
+
+# WAL lets readers (e.g. `recurring-txns list`) run while an auto-process run is writing.
+# With WAL, synchronous=NORMAL is still safe against corruption and avoids an fsync per commit.
+def configure_sqlite_connection(dbapi_connection, connection_record):
+	cursor = dbapi_connection.cursor()
+	cursor.execute("PRAGMA journal_mode=WAL")
+	cursor.execute("PRAGMA synchronous=NORMAL")
+	cursor.execute("PRAGMA cache_size=-16000")
+	cursor.execute("PRAGMA temp_store=MEMORY")
+	cursor.execute("PRAGMA busy_timeout=30000")
+	cursor.close()
+
 class RecurringEventType(TypeDecorator):
 	impl = TEXT
 	cache_ok = True
@@ -58,17 +90,298 @@ class RecurringTransaction(Base):
 	previous_occurrence: Mapped[datetime]
 	notes: Mapped[Optional[str]]
 
+	# Kept cheap, as it's used in logs on hot paths. describe() includes the human-readable
+	# rule and next occurrence, which need the rule to be evaluated.
 	def __repr__(self) -> str:
+		return f"RecurringTransaction(id={self.id!r}, description={self.description!r}, amount={self.amount!r}, category={self.category!r}, dedupe_string={self.dedupe_string!r}, previous_occurrence={self.previous_occurrence!r})"
+
+	def describe(self) -> str:
 		return f"RecurringTransaction(id={self.id!r}, description={self.description!r}, amount={self.amount!r}, category={self.category!r}, dedupe_string={self.dedupe_string!r}, recurring_event=RecurringEvent(rule='{self.recurring_event.format(rrule_for_txn(self))}'), previous_occurrence={self.previous_occurrence!r}, inferred_next_occurrence='{get_next_occurrence_for_txn(self)}')"
 
+# Small key/value store for state that needs to survive between runs, such as sync watermarks
+class SyncState(Base):
+	__tablename__ = 'sync_state'
+
+	key: Mapped[str] = mapped_column(primary_key=True)
+	value: Mapped[str]
+
+	def __repr__(self) -> str:
+		return f"SyncState(key={self.key!r}, value={self.value!r})"
+
+# The input fingerprint of each stage's last successful run, so stages whose inputs haven't
+# changed can be skipped
+class StageRun(Base):
+	__tablename__ = 'stage_runs'
+
+	stage: Mapped[str] = mapped_column(primary_key=True)
+	fingerprint: Mapped[str]
+	completed_at: Mapped[datetime]
+
+	def __repr__(self) -> str:
+		return f"StageRun(stage={self.stage!r}, fingerprint={self.fingerprint!r}, completed_at={self.completed_at!r})"
+
+# Exclusive ownership of a stage (or shard of one) by a process, until `expires_at`. The
+# owner extends the expiry while it works (see leases.py); once it lapses, e.g. because the
+# owner died, another process may take the lease over.
+class Lease(Base):
+	__tablename__ = 'lease'
+
+	name: Mapped[str] = mapped_column(primary_key=True)
+	owner: Mapped[str]
+	expires_at: Mapped[datetime]
+
+	def __repr__(self) -> str:
+		return f"Lease(name={self.name!r}, owner={self.owner!r}, expires_at={self.expires_at!r})"
+
+# Daily Monarch Money account balances, as seen by each run's account fetch. A day's
+# balance is the one seen by its last run. `date` is YYYY-MM-DD.
+class AccountBalance(Base):
+	__tablename__ = 'account_balance'
+
+	account_id: Mapped[str] = mapped_column(primary_key=True)
+	date: Mapped[str] = mapped_column(primary_key=True)
+	balance: Mapped[Optional[float]]
+
+	def __repr__(self) -> str:
+		return f"AccountBalance(account_id={self.account_id!r}, date={self.date!r}, balance={self.balance!r})"
+
+# Local copy of Monarch Money transactions, for the opt-in mirror (see monarch_mirror.py).
+# `data` holds the transaction as the API returned it; the other columns are copied out of
+# it for filtering. `owner` is the Monarch login, so profiles can share a DB.
+class MonarchTransaction(Base):
+	__tablename__ = 'monarch_transaction'
+	__table_args__ = (
+		UniqueConstraint('owner', 'id'),
+		Index('ix_monarch_transaction_date', 'owner', 'date'),
+		Index('ix_monarch_transaction_account', 'owner', 'account_id', 'date'),
+		Index('ix_monarch_transaction_category', 'owner', 'category_id', 'date'),
+	)
+
+	# a stable integer key for the full-text index to refer to
+	pk: Mapped[int] = mapped_column(primary_key=True)
+	owner: Mapped[str]
+	id: Mapped[str]
+	date: Mapped[str]
+	account_id: Mapped[Optional[str]]
+	category_id: Mapped[Optional[str]]
+	is_split: Mapped[bool]
+	updated_at: Mapped[str]
+	merchant: Mapped[Optional[str]]
+	plaid_name: Mapped[Optional[str]]
+	notes: Mapped[Optional[str]]
+	data: Mapped[str]
+
+	def __repr__(self) -> str:
+		return f"MonarchTransaction(owner={self.owner!r}, id={self.id!r}, date={self.date!r}, merchant={self.merchant!r}, updated_at={self.updated_at!r})"
+
+def monarch_transaction_row(owner, txn):
+	return {
+		"owner": owner,
+		"id": txn['id'],
+		"date": txn['date'],
+		"account_id": (txn.get('account') or {}).get('id'),
+		"category_id": (txn.get('category') or {}).get('id'),
+		"is_split": bool(txn.get('isSplitTransaction')),
+		"updated_at": txn.get('updatedAt') or "",
+		"merchant": (txn.get('merchant') or {}).get('name'),
+		"plaid_name": txn.get('plaidName'),
+		"notes": txn.get('notes'),
+		"data": json.dumps(txn)
+	}
+
+# Full-text index over the searchable text of mirrored transactions, kept up to date by
+# triggers. The trigram tokenizer gives the same case-insensitive substring matching as
+# Monarch's search. Returns False if this SQLite build can't support it, in which case
+# searches fall back to LIKE.
+def create_monarch_transaction_search(engine):
+	statements = [
+		"CREATE VIRTUAL TABLE IF NOT EXISTS monarch_transaction_fts USING fts5(merchant, plaid_name, notes, content='monarch_transaction', content_rowid='pk', tokenize='trigram')",
+		"CREATE TRIGGER IF NOT EXISTS monarch_transaction_ai AFTER INSERT ON monarch_transaction BEGIN "
+			"INSERT INTO monarch_transaction_fts(rowid, merchant, plaid_name, notes) VALUES (new.pk, new.merchant, new.plaid_name, new.notes); END",
+		"CREATE TRIGGER IF NOT EXISTS monarch_transaction_ad AFTER DELETE ON monarch_transaction BEGIN "
+			"INSERT INTO monarch_transaction_fts(monarch_transaction_fts, rowid, merchant, plaid_name, notes) VALUES ('delete', old.pk, old.merchant, old.plaid_name, old.notes); END",
+		"CREATE TRIGGER IF NOT EXISTS monarch_transaction_au AFTER UPDATE ON monarch_transaction BEGIN "
+			"INSERT INTO monarch_transaction_fts(monarch_transaction_fts, rowid, merchant, plaid_name, notes) VALUES ('delete', old.pk, old.merchant, old.plaid_name, old.notes); "
+			"INSERT INTO monarch_transaction_fts(rowid, merchant, plaid_name, notes) VALUES (new.pk, new.merchant, new.plaid_name, new.notes); END"
+	]
+
+	try:
+		with engine.begin() as connection:
+			exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'monarch_transaction_fts'")).first()
+			for statement in statements:
+				connection.execute(text(statement))
+
+			if not exists:
+				# index any transactions mirrored before the index existed
+				connection.execute(text("INSERT INTO monarch_transaction_fts(monarch_transaction_fts) VALUES ('rebuild')"))
+	except OperationalError:
+		logger.warning("SQLite FTS5 trigram tokenizer is unavailable; mirrored transaction searches will be slower")
+		return False
+
+	return True
+
+# Local copy of Splitwise expenses, for the opt-in expense store (see splitwise_store.py).
+# Rows provide the same getters as the Splitwise SDK's Expense, so they can be used in its
+# place. `owner` is the Splitwise user the expenses were fetched as.
+class SplitwiseExpense(Base):
+	__tablename__ = 'splitwise_expense'
+	__table_args__ = (
+		Index('ix_splitwise_expense_date', 'owner', 'date'),
+		Index('ix_splitwise_expense_updated_at', 'owner', 'updated_at'),
+	)
+
+	owner: Mapped[int] = mapped_column(primary_key=True)
+	id: Mapped[int] = mapped_column(primary_key=True)
+	description: Mapped[str]
+	cost: Mapped[str]
+	date: Mapped[str]
+	updated_at: Mapped[str]
+	deleted_at: Mapped[Optional[str]]
+	# JSON list of {"from", "to", "amount"} debts
+	repayments: Mapped[str]
+	shares: Mapped[List["SplitwiseShare"]] = relationship(lazy="selectin", viewonly=True)
+
+	def getId(self):
+		return self.id
+
+	def getDescription(self):
+		return self.description
+
+	def getCost(self):
+		return self.cost
+
+	def getDate(self):
+		return self.date
+
+	def getUpdatedAt(self):
+		return self.updated_at
+
+	def getDeletedAt(self):
+		return self.deleted_at
+
+	def getUsers(self):
+		return self.shares
+
+	def getRepayments(self):
+		from splitwise.debt import Debt
+		return [Debt(repayment) for repayment in json.loads(self.repayments)]
+
+	def __repr__(self) -> str:
+		return f"SplitwiseExpense(owner={self.owner!r}, id={self.id!r}, description={self.description!r}, cost={self.cost!r}, date={self.date!r}, updated_at={self.updated_at!r}, deleted_at={self.deleted_at!r})"
+
+# Each user's part of a stored Splitwise expense. The expense date is copied here, so
+# expenses with a given friend over a range of dates can be found from the index alone.
+class SplitwiseShare(Base):
+	__tablename__ = 'splitwise_share'
+	__table_args__ = (
+		ForeignKeyConstraint(['owner', 'expense_id'], ['splitwise_expense.owner', 'splitwise_expense.id']),
+		Index('ix_splitwise_share_user_date', 'owner', 'user_id', 'date'),
+	)
+
+	owner: Mapped[int] = mapped_column(primary_key=True)
+	expense_id: Mapped[int] = mapped_column(primary_key=True)
+	user_id: Mapped[int] = mapped_column(primary_key=True)
+	date: Mapped[str]
+	paid_share: Mapped[str]
+	owed_share: Mapped[str]
+
+	def getId(self):
+		return self.user_id
+
+	def getPaidShare(self):
+		return self.paid_share
+
+	def getOwedShare(self):
+		return self.owed_share
+
+	def __repr__(self) -> str:
+		return f"SplitwiseShare(expense_id={self.expense_id!r}, user_id={self.user_id!r}, paid_share={self.paid_share!r}, owed_share={self.owed_share!r})"
+
 class Db:
 	def __init__(self, db_path):
-		self.engine = create_engine("sqlite:///%s" % db_path)
-		Base.metadata.create_all(self.engine)
+		# the engine (and schema creation) is deferred until the DB is first used, so
+		# commands that never touch the DB don't pay for it
+		self.db_path = db_path
+		self._engine = None
+		self.engine_lock = threading.Lock()
+		self.local = threading.local()
+		self.full_text_search = False
+
+	@property
+	def engine(self):
+		with self.engine_lock:
+			if self._engine is None:
+				self._engine = create_engine("sqlite:///%s" % self.db_path)
+				event.listen(self._engine, "connect", configure_sqlite_connection)
+				Base.metadata.create_all(self._engine)
+				self.full_text_search = create_monarch_transaction_search(self._engine)
+			return self._engine
+
+	# Groups every Db call made inside the block (on this thread) into a single session
+	# and transaction, committed once when the outermost block exits, or rolled back if
+	# it raises. Db methods called outside of a block each run in their own unit of work.
+	#
+	# A `separate` block gets its own session and transaction even inside another block,
+	# for writes that must be committed whatever happens to the caller's.
+	@contextmanager
+	def unit_of_work(self, separate=False):
+		outer_session = getattr(self.local, "session", None)
+		if outer_session is not None and not separate:
+			yield outer_session
+			return
+
+		with Session(self.engine, expire_on_commit=False) as session:
+			self.local.session = session
+			try:
+				yield session
+				session.commit()
+			finally:
+				self.local.session = outer_session
+
+	def get_state(self, key, default=None):
+		with self.unit_of_work() as session:
+			state = session.get(SyncState, key)
+			return json.loads(state.value) if state else default
+
+	def set_state(self, key, value):
+		with self.unit_of_work() as session:
+			session.merge(SyncState(key=key, value=json.dumps(value)))
+
+	def get_stage_run(self, stage):
+		with self.unit_of_work() as session:
+			return session.get(StageRun, stage)
+
+	def record_stage_run(self, stage, fingerprint):
+		with self.unit_of_work() as session:
+			session.merge(StageRun(stage=stage, fingerprint=fingerprint, completed_at=datetime.now()))
+
+	# Takes the lease if it's free, expired or already ours. Returns whether we hold it.
+	def acquire_lease(self, name, owner, ttl):
+		now = datetime.now()
+		stmt = sqlite_insert(Lease).values(name=name, owner=owner, expires_at=now + ttl)
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[Lease.name],
+			set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+			where=(Lease.expires_at < now) | (Lease.owner == owner))
+
+		with self.unit_of_work() as session:
+			session.execute(stmt)
+			return session.scalar(select(Lease.owner).where(Lease.name == name)) == owner
+
+	# Extends a lease we hold. Returns False if it has been lost to another process.
+	def renew_lease(self, name, owner, ttl):
+		stmt = update(Lease).where(Lease.name == name, Lease.owner == owner).values(expires_at=datetime.now() + ttl)
+		with self.unit_of_work() as session:
+			return session.execute(stmt).rowcount == 1
+
+	def release_lease(self, name, owner):
+		stmt = delete(Lease).where(Lease.name == name, Lease.owner == owner)
+		with self.unit_of_work() as session:
+			session.execute(stmt)
 
 	def get_all_recurring_transactions(self):
 		stmt = select(RecurringTransaction)
-		with Session(self.engine) as session:
+		with self.unit_of_work() as session:
 			return session.scalars(stmt).all()
 
 	def create_recurring_transaction(self, description, amount_decimal, category, recurring_event):
@@ -78,60 +391,92 @@ class Db:
 		if recurring_event.dtstart != None and recurring_event.dtstart <= datetime.now():
 			logger.warn("Warning! Start date is in the past. A transaction will _not_ be created automatically for that start time.")
 
-		txn = RecurringTransaction(
-			description=description,
-			amount=str(amount_decimal),
-			category=category,
-			dedupe_string=token_hex(8),
-			recurring_event=recurring_event,
-			previous_occurrence=datetime.now() if recurring_event.dtstart == None else min(datetime.now(), recurring_event.dtstart)
-		)
+		txn = new_recurring_transaction(description, amount_decimal, category, recurring_event, recurring_event.dtstart)
 
-		with Session(self.engine) as session:
+		with self.unit_of_work() as session:
 			session.add(txn)
-			session.commit()
-			txn = session.get(RecurringTransaction, txn.id)
-			logger.info(f"Created new recurring transaction: {txn}. Next occurrence: {get_next_occurrence_for_txn(txn)}")
+			session.flush()
+			session.refresh(txn)
+			logger.info("Created new recurring transaction: %s", txn.describe())
+
+	# Adds new transactions (see new_recurring_transaction) all at once, so either all of them
+	# are added or none are
+	def create_recurring_transactions(self, txns):
+		with self.unit_of_work() as session:
+			session.add_all(txns)
+
+		logger.info("Created %s new recurring transactions", len(txns))
 
 	def remove_recurring_transaction(self, id):
-		with Session(self.engine) as session:
+		with self.unit_of_work() as session:
 			txn = session.get(RecurringTransaction, id)
-			logger.info("Removing recurring transaction: %s" % txn)
+			logger.info("Removing recurring transaction: %s", txn)
 			session.delete(txn)
-			session.commit()
-			logger.info("Removed recurring transaction")
 
-	def get_past_due_recurring_transactions(self, exclude_ids=set()):
-		def txn_filter(txn):
-			rules = rrule.rrulestr(rrule_for_txn(txn))
-			return rules.after(txn.previous_occurrence) < datetime.now() and txn.id not in exclude_ids
+		logger.info("Removed recurring transaction")
+
+	# Returns the past due transactions, paired with their next occurrence. Expired
+	# transactions are cleaned up in the same pass, so each rule is only evaluated once.
+	# `shard` is an (index, count) pair, limiting the transactions to those whose ID is
+	# `index` modulo `count`.
+	def get_past_due_recurring_transactions(self, exclude_ids=set(), shard=None):
+		now = datetime.now()
+		past_due = []
+
+		stmt = select(RecurringTransaction)
+		if shard:
+			index, count = shard
+			stmt = stmt.where(RecurringTransaction.id % count == index)
+
+		with self.unit_of_work() as session:
+			for txn in session.scalars(stmt).all():
+				next_occurrence = get_next_occurrence_for_txn(txn)
+				if not next_occurrence:
+					# if there is an end date, and if the final occurrence is equal to the previous one
+					logger.info("Cleaning up expired recurring transaction %s", txn)
+					session.delete(txn)
+				elif next_occurrence < now and txn.id not in exclude_ids:
+					past_due.append((txn, next_occurrence))
 
-		self.clean_up_expired_recurring_transactions()
-		return list(filter(txn_filter, self.get_all_recurring_transactions()))
+		return past_due
 
 	def clean_up_expired_recurring_transactions(self):
 		stmt = select(RecurringTransaction)
 
-		with Session(self.engine) as session:
+		with self.unit_of_work() as session:
 			for txn in session.scalars(stmt).all():
-				rules = rrule.rrulestr(rrule_for_txn(txn))
-				if not rules.after(txn.previous_occurrence):
+				if not get_next_occurrence_for_txn(txn):
 					# if there is an end date, and if the final occurrence is equal to the previous one
-					logger.info("Cleaning up expired recurring transaction %s" % txn)
+					logger.info("Cleaning up expired recurring transaction %s", txn)
 					session.delete(txn)
-			session.commit()
 
-	def process_recurring_transaction_completion(self, id):
-		with Session(self.engine) as session:
+	# new_occurrence may be passed in when the caller has already computed it. If
+	# expected_previous_occurrence is given, the transaction is only updated if its previous
+	# occurrence still has that value, so an occurrence can't be completed twice by
+	# processes racing each other. Returns whether the transaction was updated.
+	def process_recurring_transaction_completion(self, id, new_occurrence=None, expected_previous_occurrence=None):
+		with self.unit_of_work() as session:
 			txn = session.get(RecurringTransaction, id)
-			new_occurrence = get_next_occurrence_for_txn(txn)
-			next_occurrence = rrule.rrulestr(rrule_for_txn(txn)).after(new_occurrence)
-			logger.info(f"updating previous occurrence for transaction \"{txn.description}\" from {txn.previous_occurrence} to {new_occurrence}. Next occurrence will be {next_occurrence}")
-			txn.previous_occurrence = new_occurrence
-			session.commit()
+			new_occurrence = new_occurrence or get_next_occurrence_for_txn(txn)
+			logger.info("updating previous occurrence for transaction \"%s\" from %s to %s", txn.description, txn.previous_occurrence, new_occurrence)
+
+			if expected_previous_occurrence is None:
+				txn.previous_occurrence = new_occurrence
+				return True
+
+			stmt = update(RecurringTransaction) \
+				.where(RecurringTransaction.id == id, RecurringTransaction.previous_occurrence == expected_previous_occurrence) \
+				.values(previous_occurrence=new_occurrence) \
+				.execution_options(synchronize_session="fetch")
+
+			if session.execute(stmt).rowcount == 0:
+				logger.warning("Recurring transaction \"%s\" was already completed by another process", txn.description)
+				return False
+
+			return True
 
 	def get_next_occurrence_for_txn_by_id(self, id):
-		with Session(self.engine) as session:
+		with self.unit_of_work() as session:
 			return get_next_occurrence_for_txn(session.get(RecurringTransaction, id))
 
 	def schedule_single_transaction(self, description, amount_decimal, category, txn_date, dedupe, notes=None):
@@ -162,13 +507,165 @@ class Db:
 		)
 
 		sel_stmt = select(RecurringTransaction).where(RecurringTransaction.dedupe_string == dedupe)
-		with Session(self.engine) as session:
+		with self.unit_of_work() as session:
 			if session.execute(sel_stmt).first() is not None:
-				logger.info("Duplicate scheduled transaction found: %s (dedupe string: %s). Skipping..." % (description, dedupe))
+				logger.info("Duplicate scheduled transaction found: %s (dedupe string: %s). Skipping...", description, dedupe)
 				return
 
 			session.add(txn)
-			session.commit()
-			txn = session.get(RecurringTransaction, txn.id)
-			logger.info(f"Scheduled new transaction: {txn}. Execution date: {get_next_occurrence_for_txn(txn)}")
+			session.flush()
+			session.refresh(txn)
+			logger.info("Scheduled new transaction: %s", txn.describe())
+
+	# Conditions matching the filters of MonarchMoney.get_transactions. Only call this once
+	# the engine exists (i.e. within a unit of work), so full_text_search is known.
+	def monarch_transaction_filters(self, owner, search="", start_date=None, end_date=None, category_ids=[], account_ids=[], is_split=None):
+		filters = [MonarchTransaction.owner == owner]
+
+		if search and self.full_text_search and len(search) >= 3:
+			phrase = '"%s"' % search.replace('"', '""')
+			filters.append(MonarchTransaction.pk.in_(text("SELECT rowid FROM monarch_transaction_fts WHERE monarch_transaction_fts MATCH :phrase").bindparams(phrase=phrase)))
+		elif search:
+			pattern = "%%%s%%" % search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+			filters.append(or_(*(column.like(pattern, escape="\\") for column in (MonarchTransaction.merchant, MonarchTransaction.plaid_name, MonarchTransaction.notes))))
+
+		if start_date:
+			filters.append(MonarchTransaction.date >= start_date)
+		if end_date:
+			filters.append(MonarchTransaction.date <= end_date)
+		if category_ids:
+			filters.append(MonarchTransaction.category_id.in_(category_ids))
+		if account_ids:
+			filters.append(MonarchTransaction.account_id.in_(account_ids))
+		if is_split is not None:
+			filters.append(MonarchTransaction.is_split == is_split)
+
+		return filters
+
+	# Returns mirrored transactions, as the API returned them, newest first (like the API)
+	def search_monarch_transactions(self, owner, limit=None, offset=0, **filters):
+		with self.unit_of_work() as session:
+			stmt = select(MonarchTransaction.data) \
+				.where(*self.monarch_transaction_filters(owner, **filters)) \
+				.order_by(MonarchTransaction.date.desc(), MonarchTransaction.id) \
+				.limit(limit).offset(offset)
+
+			return [json.loads(data) for data in session.scalars(stmt)]
+
+	def count_monarch_transactions(self, owner, **filters):
+		with self.unit_of_work() as session:
+			stmt = select(func.count()).select_from(MonarchTransaction).where(*self.monarch_transaction_filters(owner, **filters))
+			return session.scalar(stmt)
+
+	# Maps the ID of each mirrored transaction dated within the range to its last update time
+	def get_monarch_transaction_versions(self, owner, start_date=None, end_date=None):
+		with self.unit_of_work() as session:
+			stmt = select(MonarchTransaction.id, MonarchTransaction.updated_at) \
+				.where(*self.monarch_transaction_filters(owner, start_date=start_date, end_date=end_date))
+
+			return dict(session.execute(stmt).all())
+
+	def upsert_monarch_transactions(self, owner, txns):
+		if not txns:
+			return
+
+		stmt = sqlite_insert(MonarchTransaction)
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[MonarchTransaction.owner, MonarchTransaction.id],
+			set_={column: stmt.excluded[column] for column in ("date", "account_id", "category_id", "is_split", "updated_at", "merchant", "plaid_name", "notes", "data")})
+
+		with self.unit_of_work() as session:
+			session.execute(stmt, [monarch_transaction_row(owner, txn) for txn in txns])
+
+	def delete_monarch_transactions(self, owner, ids):
+		if not ids:
+			return
+
+		stmt = delete(MonarchTransaction).where(MonarchTransaction.owner == owner, MonarchTransaction.id.in_(ids))
+		with self.unit_of_work() as session:
+			session.execute(stmt)
+
+	# Stores Splitwise expenses (anything with the SDK Expense's getters), replacing any
+	# stored copies. Deleted expenses are kept, with their deletion time.
+	def upsert_splitwise_expenses(self, owner, expenses):
+		if not expenses:
+			return
+
+		expense_rows = [{
+			"owner": owner,
+			"id": expense.getId(),
+			"description": expense.getDescription() or "",
+			"cost": expense.getCost(),
+			"date": expense.getDate(),
+			"updated_at": expense.getUpdatedAt(),
+			"deleted_at": expense.getDeletedAt(),
+			"repayments": json.dumps([{"from": debt.getFromUser(), "to": debt.getToUser(), "amount": debt.getAmount()} for debt in expense.getRepayments()])
+		} for expense in expenses]
+
+		share_rows = [{
+			"owner": owner,
+			"expense_id": expense.getId(),
+			"user_id": user.getId(),
+			"date": expense.getDate(),
+			"paid_share": user.getPaidShare(),
+			"owed_share": user.getOwedShare()
+		} for expense in expenses for user in expense.getUsers()]
+
+		stmt = sqlite_insert(SplitwiseExpense)
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[SplitwiseExpense.owner, SplitwiseExpense.id],
+			set_={column: stmt.excluded[column] for column in ("description", "cost", "date", "updated_at", "deleted_at", "repayments")})
+
+		with self.unit_of_work() as session:
+			session.execute(delete(SplitwiseShare).where(SplitwiseShare.owner == owner, SplitwiseShare.expense_id.in_([row["id"] for row in expense_rows])))
+			session.execute(stmt, expense_rows)
+			# executing an insert with no rows would insert a row of defaults
+			if share_rows:
+				session.execute(insert(SplitwiseShare), share_rows)
+
+	# Takes the same filters as Splitwise.getExpenses, as ISO 8601 UTC strings. Like
+	# Splitwise, deleted expenses are included, and the newest expenses come first.
+	def get_splitwise_expenses(self, owner, friend_id=None, dated_after=None, dated_before=None, updated_after=None, updated_before=None, limit=None, offset=0):
+		stmt = select(SplitwiseExpense).where(SplitwiseExpense.owner == owner)
+
+		if friend_id is not None:
+			friend_expense_ids = select(SplitwiseShare.expense_id).where(SplitwiseShare.owner == owner, SplitwiseShare.user_id == friend_id)
+			if dated_after:
+				friend_expense_ids = friend_expense_ids.where(SplitwiseShare.date > dated_after)
+			if dated_before:
+				friend_expense_ids = friend_expense_ids.where(SplitwiseShare.date < dated_before)
+			stmt = stmt.where(SplitwiseExpense.id.in_(friend_expense_ids))
+
+		if dated_after:
+			stmt = stmt.where(SplitwiseExpense.date > dated_after)
+		if dated_before:
+			stmt = stmt.where(SplitwiseExpense.date < dated_before)
+		if updated_after:
+			stmt = stmt.where(SplitwiseExpense.updated_at > updated_after)
+		if updated_before:
+			stmt = stmt.where(SplitwiseExpense.updated_at < updated_before)
+
+		stmt = stmt.order_by(SplitwiseExpense.date.desc(), SplitwiseExpense.id.desc()).limit(limit).offset(offset)
+
+		with self.unit_of_work() as session:
+			return session.scalars(stmt).all()
+
+	# Records the given balances, a map of account ID to balance, as of the given date
+	def record_account_balances(self, balances, day):
+		if not balances:
+			return
+
+		stmt = sqlite_insert(AccountBalance)
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[AccountBalance.account_id, AccountBalance.date],
+			set_={"balance": stmt.excluded.balance})
+
+		with self.unit_of_work() as session:
+			session.execute(stmt, [{"account_id": account_id, "date": day.isoformat(), "balance": balance} for account_id, balance in balances.items()])
+
+	# Returns the account's recorded balance as of the given date, or None if none was recorded
+	def get_account_balance(self, account_id, day):
+		stmt = select(AccountBalance.balance).where(AccountBalance.account_id == account_id, AccountBalance.date == day.isoformat())
+		with self.unit_of_work() as session:
+			return session.scalar(stmt)
 
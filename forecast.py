@@ -0,0 +1,161 @@
+import logging
+import numpy as np
+
+from datetime import datetime, time
+from dateutil import rrule
+from dateutil import parser as date_parser
+from decimal import Decimal
+
+from util import rrule_for_txn
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+
+# Rule parts the array-based expansion understands. Rules using anything else (e.g.
+# "first friday of every month") fall back to dateutil's rrule expansion.
+SUPPORTED_RULE_PARTS = {"FREQ", "INTERVAL", "COUNT", "UNTIL", "BYDAY", "BYMONTHDAY", "BYMONTH", "BYHOUR", "BYMINUTE", "BYSECOND", "WKST"}
+
+class UnsupportedRule(Exception):
+	pass
+
+# Splits a normalized rule (see util.normalize_rfc_rule) into its start datetime and RRULE parts
+def parse_rule(rfc_rule):
+	dtstart = None
+	parts = None
+	for line in rfc_rule.splitlines():
+		if line.startswith("DTSTART:"):
+			dtstart = date_parser.parse(line[len("DTSTART:"):]).replace(tzinfo=None)
+		elif line.startswith("RRULE:"):
+			parts = dict(part.split("=", 1) for part in line[len("RRULE:"):].split(";"))
+
+	if dtstart is None or parts is None:
+		raise UnsupportedRule(rfc_rule)
+
+	if not set(parts) <= SUPPORTED_RULE_PARTS or any(parts.get(part, "0") != "0" for part in ("BYHOUR", "BYMINUTE", "BYSECOND")) or parts.get("WKST", "MO") != "MO":
+		raise UnsupportedRule(rfc_rule)
+
+	return dtstart, parts
+
+def int_list(value):
+	return [int(v) for v in value.split(",")]
+
+# Days of each month in `months` given by `month_days`, which may be negative to count from
+# the end of the month. Returns the days, and a mask of which ones actually exist.
+def days_in_months(months, month_days):
+	month_starts = months.astype("datetime64[D]")[:, None]
+	month_ends = (months + 1).astype("datetime64[D]")[:, None] - 1
+	month_days = np.array(month_days)
+
+	days = np.where(month_days > 0, month_starts + (month_days - 1), month_ends + (month_days + 1))
+	valid = days.astype("datetime64[M]") == months[:, None]
+
+	return days.ravel(), valid.ravel()
+
+# Every candidate day the rule could fall on, from its start up to `end`
+def candidate_days(dtstart, parts, end):
+	start = np.datetime64(dtstart.date(), "D")
+	interval = int(parts.get("INTERVAL", 1))
+	freq = parts["FREQ"]
+
+	if freq == "DAILY" and not {"BYDAY", "BYMONTHDAY", "BYMONTH"} & set(parts):
+		return np.arange(start, end + 1, interval)
+
+	if freq == "WEEKLY" and not {"BYMONTHDAY", "BYMONTH"} & set(parts):
+		weekdays = [WEEKDAYS.index(day) for day in parts["BYDAY"].split(",")] if "BYDAY" in parts else [dtstart.weekday()]
+		week_start = start - dtstart.weekday()
+		weeks = np.arange(week_start, end + 1, 7 * interval)
+		return (weeks[:, None] + np.array(sorted(weekdays))).ravel()
+
+	if freq == "MONTHLY" and not {"BYDAY", "BYMONTH"} & set(parts):
+		months = np.arange(start.astype("datetime64[M]"), end.astype("datetime64[M]") + 1, interval)
+		days, valid = days_in_months(months, int_list(parts.get("BYMONTHDAY", str(dtstart.day))))
+		return days[valid]
+
+	if freq == "YEARLY" and "BYDAY" not in parts:
+		# like rrule, a rule with month days but no months falls in every month
+		if "BYMONTH" in parts:
+			month_numbers = int_list(parts["BYMONTH"])
+		elif "BYMONTHDAY" in parts:
+			month_numbers = list(range(1, 13))
+		else:
+			month_numbers = [dtstart.month]
+
+		years = np.arange(start.astype("datetime64[Y]"), end.astype("datetime64[Y]") + 1, interval)
+		months = (years.astype("datetime64[M]")[:, None] + (np.array(month_numbers) - 1)).ravel()
+		days, valid = days_in_months(months, int_list(parts.get("BYMONTHDAY", str(dtstart.day))))
+		return days[valid]
+
+	raise UnsupportedRule(parts)
+
+# Returns the days of every occurrence of the rule strictly after `after` and on or before
+# the date `until`, as a datetime64[D] array. Occurrences are always at midnight, per
+# util.normalize_rfc_rule.
+def expand_rule(rfc_rule, after, until):
+	until_day = np.datetime64(until, "D")
+	try:
+		dtstart, parts = parse_rule(rfc_rule)
+
+		end = until_day
+		if "UNTIL" in parts:
+			rule_until = date_parser.parse(parts["UNTIL"]).replace(tzinfo=None)
+			end = min(end, np.datetime64(rule_until.date(), "D"))
+
+		days = np.sort(candidate_days(dtstart, parts, end))
+
+		# like rrule, only occurrences on or after the start count towards COUNT
+		days = days[days.astype("datetime64[s]") >= np.datetime64(dtstart, "s")]
+		if "COUNT" in parts:
+			days = days[:int(parts["COUNT"])]
+	except UnsupportedRule:
+		occurrences = rrule.rrulestr(rfc_rule).between(after, datetime.combine(until, time.max), inc=True)
+		days = np.array([occurrence.date() for occurrence in occurrences], dtype="datetime64[D]")
+
+	return days[(days.astype("datetime64[s]") > np.datetime64(after, "s")) & (days <= until_day)]
+
+# Expands every recurring transaction's occurrences up to (and including) `until`, and totals
+# their amounts per category and month. `by` may be "category" or "month" to total over just
+# one of them. Returns a header and rows, ready for printing.
+def forecast_recurring_transactions(txns, until, by=None):
+	categories = sorted({txn.category for txn in txns})
+	category_index = {category: i for i, category in enumerate(categories)}
+
+	occurrence_days = []
+	for txn in txns:
+		occurrence_days.append(expand_rule(rrule_for_txn(txn), txn.previous_occurrence, until))
+
+	counts = np.array([len(days) for days in occurrence_days], dtype=np.int64)
+	if counts.sum() == 0:
+		return [], []
+
+	days = np.concatenate(occurrence_days)
+	category_ids = np.repeat([category_index[txn.category] for txn in txns], counts)
+	amounts = np.repeat([int(Decimal(txn.amount) * 100) for txn in txns], counts)
+
+	logger.debug(f"Expanded {len(txns)} recurring transactions into {len(days)} occurrences")
+
+	first_month = days.min().astype("datetime64[M]")
+	month_ids = (days.astype("datetime64[M]") - first_month).astype(np.int64)
+	month_count = month_ids.max() + 1
+
+	# totals[category, month], summed in a single pass over all occurrences
+	keys = category_ids * month_count + month_ids
+	totals = np.bincount(keys, weights=amounts, minlength=len(categories) * month_count).reshape(len(categories), month_count)
+	occurrences = np.bincount(keys, minlength=len(categories) * month_count).reshape(len(categories), month_count)
+
+	def amount(cents):
+		return str((Decimal(int(round(cents))) / 100).quantize(Decimal("0.01")))
+
+	months = [str(first_month + i) for i in range(month_count)]
+
+	if by == "category":
+		return ["category", "occurrences", "amount"], [
+			[categories[c], str(occurrences[c].sum()), amount(totals[c].sum())] for c in range(len(categories))]
+
+	if by == "month":
+		return ["month", "occurrences", "amount"], [
+			[months[m], str(occurrences[:, m].sum()), amount(totals[:, m].sum())] for m in range(month_count) if occurrences[:, m].sum() > 0]
+
+	return ["month", "category", "occurrences", "amount"], [
+		[months[m], categories[c], str(occurrences[c, m]), amount(totals[c, m])]
+		for m in range(month_count) for c in range(len(categories)) if occurrences[c, m] > 0]
@@ -0,0 +1,81 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from datetime import timedelta
+from secrets import token_hex
+
+logger = logging.getLogger(__name__)
+
+# A lease lapses this long after its owner's last heartbeat, so work owned by a process
+# that died is picked up again by the next run after this long
+LEASE_TTL = timedelta(minutes=5)
+
+# identifies this process as a lease owner
+PROCESS_OWNER = f"{socket.gethostname()}:{os.getpid()}:{token_hex(4)}"
+
+# the lease held by the work running on each thread
+held = threading.local()
+
+class LeaseLost(Exception):
+	pass
+
+# Exclusive ownership of some named work (e.g. a stage) across processes sharing a DB.
+# Used as a context manager: `acquired` says whether the lease was taken, and if it was, a
+# heartbeat thread renews it every third of its TTL until the block exits.
+#
+# If the lease is taken by another process (or can't be renewed before it lapses), `lost`
+# is set. Loops working under a lease call check_lease() between items, to stop before
+# they duplicate the new holder's work.
+class Lease:
+	def __init__(self, db, name, ttl=LEASE_TTL):
+		self.db = db
+		self.name = name
+		self.ttl = ttl
+		self.acquired = False
+		self.lost = threading.Event()
+		self.stopped = threading.Event()
+		self.heartbeat = None
+
+	def __enter__(self):
+		self.acquired = self.db.acquire_lease(self.name, PROCESS_OWNER, self.ttl)
+
+		if self.acquired:
+			held.lease = self
+			self.heartbeat = threading.Thread(target=self.keep_alive, name=f"lease-{self.name}", daemon=True)
+			self.heartbeat.start()
+		else:
+			logger.debug("Lease %s is held by another process", self.name)
+
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if self.acquired:
+			held.lease = None
+			self.stopped.set()
+			self.heartbeat.join()
+			self.db.release_lease(self.name, PROCESS_OWNER)
+
+	def keep_alive(self):
+		renewed_at = time.monotonic()
+		while not self.stopped.wait(self.ttl.total_seconds() / 3):
+			try:
+				if not self.db.renew_lease(self.name, PROCESS_OWNER, self.ttl):
+					logger.error("Lease %s was lost to another process", self.name)
+					self.lost.set()
+					return
+				renewed_at = time.monotonic()
+			except Exception:
+				logger.exception("Failed to renew lease %s", self.name)
+				if time.monotonic() - renewed_at >= self.ttl.total_seconds():
+					logger.error("Lease %s lapsed before it could be renewed", self.name)
+					self.lost.set()
+					return
+
+# Raises LeaseLost if the lease held by the work on this thread has been lost
+def check_lease():
+	lease = getattr(held, "lease", None)
+	if lease is not None and lease.lost.is_set():
+		raise LeaseLost(f"Lease {lease.name} was lost to another process")
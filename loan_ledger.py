@@ -0,0 +1,109 @@
+import numpy as np
+
+from decimal import Decimal
+
+from records import Share, to_cents
+
+INTEREST_DESCRIPTION = "Personal Loan Interest"
+LOAN_START_TAG = "LOANSTART"
+
+def from_cents(cents):
+	return float(Decimal(int(cents)) / 100)
+
+def repaid(expense, from_user_id, to_user_id):
+	return sum(repayment.amount for repayment in expense.repayments if repayment.from_user_id == from_user_id and repayment.to_user_id == to_user_id)
+
+# One expense's effect on a loan: its day, the change in what the friend owes me, the new
+# charge and payment (counted as the loan stage always has: what the friend owes from an
+# expense I paid for, and what I owe from one they paid for), and whether it's an interest
+# charge or marks the start of the loan
+def loan_entry(expense, my_user_id, user_id):
+	my_share = expense.share(my_user_id) or Share(my_user_id, 0, 0)
+	their_share = expense.share(user_id) or Share(user_id, 0, 0)
+	loan_start = LOAN_START_TAG in expense.description
+
+	return (
+		expense.date[:10],
+		repaid(expense, user_id, my_user_id) - repaid(expense, my_user_id, user_id),
+		their_share.owed if my_share.paid > 0 and not loan_start else 0,
+		my_share.owed if their_share.paid > 0 else 0,
+		INTEREST_DESCRIPTION in expense.description,
+		loan_start
+	)
+
+# What a month of a loan came to: the borrower's average daily balance, the interest on it,
+# and the new charges and payments. `interest_charged` says whether the interest is already
+# on Splitwise; if so, `interest` is the amount that was charged. Amounts are in dollars.
+class MonthStatement:
+	def __init__(self, month, average_balance, interest, interest_charged, charges, payments):
+		self.month = month
+		self.average_balance = average_balance
+		self.interest = interest
+		self.interest_charged = interest_charged
+		self.charges = charges
+		self.payments = payments
+
+	def __repr__(self) -> str:
+		return f"MonthStatement(month={self.month!r}, average_balance={self.average_balance!r}, interest={self.interest!r}, interest_charged={self.interest_charged!r}, charges={self.charges!r}, payments={self.payments!r})"
+
+# The history of a personal loan to one Splitwise friend, built from the expenses shared with
+# them (as records.ExpenseRecords), as arrays of daily amounts in cents.
+#
+# The balance is what the friend owes me, from each expense's repayments between the two of
+# us. Interest accrues on each day's opening balance, so something added on a day starts
+# accruing the next day, and interest charged on the last day of a month accrues from the
+# next month on. No interest accrues up to the end of the month a loan is started in (marked
+# by an expense tagged LOANSTART).
+class LoanLedger:
+	def __init__(self, expenses, my_user_id, user_id):
+		entries = sorted(loan_entry(expense, my_user_id, user_id) for expense in expenses if not expense.deleted_at)
+		days, balance_changes, charges, payments, is_interest, is_loan_start = zip(*entries) if entries else ((),) * 6
+
+		self.days = np.array(days, dtype="datetime64[D]")
+		self.months = self.days.astype("datetime64[M]")
+		self.charges = np.array(charges, dtype=np.int64)
+		self.payments = np.array(payments, dtype=np.int64)
+
+		is_interest = np.array(is_interest, dtype=bool)
+		self.interest = np.where(is_interest, self.charges, 0)
+		self.interest_months = set(self.months[is_interest].tolist())
+
+		loan_start_days = self.days[np.array(is_loan_start, dtype=bool)]
+		self.start_month = loan_start_days.min().astype("datetime64[M]") if len(loan_start_days) else None
+
+		# opening_balances[i] is the balance before the i-th entry
+		self.opening_balances = np.concatenate(([0], np.cumsum(np.array(balance_changes, dtype=np.int64))))
+
+	# Each given day's opening balance, in cents
+	def balances_on(self, days):
+		return self.opening_balances[np.searchsorted(self.days, days, side="left")]
+
+	# Works out each of the given months (first days of them), oldest first. The interest for
+	# months not charged yet is added to the balance of the months after them, as it will be
+	# once it's charged.
+	def statements(self, months, rate, interest_free_balance=0):
+		free_cents = to_cents(interest_free_balance)
+		uncharged_interest = 0
+
+		for month in sorted(np.datetime64(month, "M") for month in months):
+			days = np.arange(month.astype("datetime64[D]"), (month + 1).astype("datetime64[D]"))
+			average_balance = np.maximum(0, self.balances_on(days) + uncharged_interest - free_cents).mean()
+
+			in_month = self.months == month
+			interest_charged = month.tolist() in self.interest_months
+
+			if interest_charged:
+				interest = int(self.interest[in_month].sum())
+			elif self.start_month is not None and month <= self.start_month:
+				interest = 0
+			else:
+				interest = int(round(average_balance * rate / 12))
+				uncharged_interest += interest
+
+			yield MonthStatement(
+				month.tolist(),
+				from_cents(round(average_balance)),
+				from_cents(interest),
+				interest_charged,
+				from_cents(self.charges[in_month].sum()),
+				from_cents(self.payments[in_month].sum()))
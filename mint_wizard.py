@@ -1,4 +1,5 @@
 import re
+import csv
 import json
 import sys
 import argparse
@@ -7,12 +8,12 @@ import logging
 import logging.config
 import os
 
-from datetime import datetime, timedelta
-from pytimeparse2 import parse as timeparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, date
 
-from splitwise_helper import SplitwiseHelper
-from monarch_money_helper import MonarchMoneyHelper
-from db import Db
+# The Monarch, Splitwise, SQLAlchemy and NumPy dependencies are slow to import, so
+# they are imported inside the commands that need them rather than here. This keeps
+# --help and the quick recurring-txns commands fast.
 import util
 
 if __name__ == "__main__":
@@ -29,99 +30,392 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = handle_exception
 
+def open_db(db_path):
+	from db import Db
+	return Db(db_path)
+
+def get_db(args):
+	if args.db is None:
+		args.db = open_db(args.db_path)
+	return args.db
+
 def list_recurring_txns(args):
 	logger.info("Listing recurring transactions")
-	[logger.info(txn) for txn in args.db.get_all_recurring_transactions()]
+	[logger.info(txn.describe()) for txn in get_db(args).get_all_recurring_transactions()]
+
+# Maps each shorthand, and each category it stands for, to its category, so a category can
+# be given either way
+def load_category_index(shorthand_json_path):
+	shorthands = json.load(open(shorthand_json_path))
+	categories = dict(shorthands)
+	categories.update({category: category for category in shorthands.values()})
+	return categories
+
+# The (description, amount, category) of each recurring transaction making up one added
+# transaction. A move between categories is a credit to the FROM category and a charge to
+# the other.
+def recurring_txn_parts(description, amount, category, move_from_category=None):
+	if not move_from_category:
+		return [(description, amount, category)]
+
+	return [
+		(f"{description} (move to \"{category}\")", str(-float(amount)), move_from_category),
+		(f"{description} (move from \"{move_from_category}\")", amount, category)
+	]
 
 def add_recurring_txn(args):
 	logger.info("Adding recurring transaction")
 
-	description = args.description
-	shorthands = json.load(open(args.shorthand_json_path))
+	categories = load_category_index(args.shorthand_json_path)
 
 	# check for category validity
-	if args.category in shorthands.values():
-		category = args.category
-	elif args.category in shorthands.keys():
-		category = shorthands[args.category]
-	else:
+	category = categories.get(args.category)
+	if category is None:
 		logger.error(f"ERROR: Given category {args.category} not a valid shorthand or category.")
 		sys.exit(1)
 
+	move_from_category = None
 	if args.move_from_category:
 		# check for category validity
-		if args.move_from_category in shorthands.values():
-			move_from_category = args.move_from_category
-		elif args.move_from_category in shorthands.keys():
-			move_from_category = shorthands[args.move_from_category]
-		else:
+		move_from_category = categories.get(args.move_from_category)
+		if move_from_category is None:
 			logger.error(f"ERROR: Given MOVE FROM category {args.move_from_category} not a valid shorthand or Mint category.")
 			sys.exit(1)
 
 		logger.info(f"Creating a MOVE from \"{move_from_category}\" to \"{category}\"")
 
-		description = f"{description} (move from \"{move_from_category}\")"
-		args.db.create_recurring_transaction(f"{args.description} (move to \"{category}\")", str(-float(args.amount)), move_from_category, args.recurring_event)
+	for description, amount, txn_category in recurring_txn_parts(args.description, args.amount, category, move_from_category):
+		get_db(args).create_recurring_transaction(description, amount, txn_category, args.recurring_event)
+
+RECURRING_TXN_EXPORT_FIELDS = ["id", "description", "amount", "category", "rule", "rrule", "previous_occurrence", "notes"]
+
+def read_recurring_txn_rows(path):
+	with open(path, newline="") as file:
+		if path.lower().endswith(".json"):
+			return json.load(file)
+		return list(csv.DictReader(file))
+
+# Validates every row before adding any, so a file with mistakes can be fixed and imported
+# again without creating duplicates
+def import_recurring_txns(args):
+	from concurrent.futures import ProcessPoolExecutor
+	from decimal import Decimal, InvalidOperation
+	from db import new_recurring_transaction
+
+	rows = read_recurring_txn_rows(args.path)
+	categories = load_category_index(args.shorthand_json_path)
+	logger.info(f"Importing {len(rows)} recurring transactions from {args.path}")
+
+	# the natural-language rule parser is slow, so the rules are parsed across processes
+	with ProcessPoolExecutor(max_workers=args.workers) as executor:
+		parsed_rules = [executor.submit(util.parse_recurring_rule, row.get("rule") or "") for row in rows]
+
+	txns = []
+	errors = []
+	for number, (row, parsed_rule) in enumerate(zip(rows, parsed_rules), start=1):
+		row_errors = [f"missing {field}" for field in ("description", "amount", "category", "rule") if not row.get(field)]
+
+		try:
+			Decimal(row.get("amount") or "0")
+		except InvalidOperation:
+			row_errors.append(f"invalid amount {row['amount']!r}")
+
+		category = categories.get(row.get("category"))
+		if row.get("category") and category is None:
+			row_errors.append(f"category {row['category']!r} is not a valid shorthand or category")
+
+		move_from_category = categories.get(row.get("move_from_category"))
+		if row.get("move_from_category") and move_from_category is None:
+			row_errors.append(f"move from category {row['move_from_category']!r} is not a valid shorthand or category")
+
+		try:
+			previous_occurrence = datetime.fromisoformat(row["previous_occurrence"]) if row.get("previous_occurrence") else None
+		except ValueError:
+			row_errors.append(f"invalid previous occurrence {row['previous_occurrence']!r}")
+
+		if row.get("rule") and parsed_rule.exception():
+			row_errors.append(str(parsed_rule.exception()))
+
+		if row_errors:
+			errors.append((number, row_errors))
+			continue
+
+		rfc_rule, dtstart = parsed_rule.result()
+		for description, amount, txn_category in recurring_txn_parts(row["description"], row["amount"], category, move_from_category):
+			txns.append(new_recurring_transaction(description, amount, txn_category, rfc_rule, dtstart, previous_occurrence=previous_occurrence, notes=row.get("notes") or None))
+
+	if errors:
+		for number, row_errors in errors:
+			logger.error(f"Row {number}: {'; '.join(row_errors)}")
+		logger.error(f"Nothing was imported, as {len(errors)} of {len(rows)} rows have errors")
+		sys.exit(1)
+
+	get_db(args).create_recurring_transactions(txns)
+
+# Exports each transaction's rule both in natural language, which `import` reads back, and
+# as the RFC rule it's stored as
+def export_recurring_txns(args):
+	rows = [{
+		"id": txn.id,
+		"description": txn.description,
+		"amount": txn.amount,
+		"category": txn.category,
+		"rule": txn.recurring_event.format(txn.recurring_event.get_RFC_rrule()),
+		"rrule": txn.recurring_event.get_RFC_rrule(),
+		"previous_occurrence": txn.previous_occurrence.isoformat(),
+		"notes": txn.notes
+	} for txn in get_db(args).get_all_recurring_transactions()]
+
+	if not args.output:
+		write_recurring_txn_export(rows, sys.stdout, args.format)
+		return
+
+	with open(args.output, "w", newline="") as output:
+		write_recurring_txn_export(rows, output, args.format)
+	logger.info(f"Exported {len(rows)} recurring transactions to {args.output}")
+
+def write_recurring_txn_export(rows, output, format):
+	if format == "json":
+		json.dump(rows, output, indent=2)
+	else:
+		writer = csv.DictWriter(output, fieldnames=RECURRING_TXN_EXPORT_FIELDS)
+		writer.writeheader()
+		writer.writerows(rows)
 
-	args.db.create_recurring_transaction(description, args.amount, category, args.recurring_event)
+def write_forecast_csv(header, rows, output):
+	writer = csv.writer(output)
+	writer.writerow(header)
+	writer.writerows(rows)
+
+def forecast_recurring_txns(args):
+	from forecast import forecast_recurring_transactions
+
+	logger.debug(f"Forecasting recurring transactions until {args.until}")
+
+	header, rows = forecast_recurring_transactions(get_db(args).get_all_recurring_transactions(), args.until, args.by)
+	if not rows:
+		logger.info("No recurring transactions occur before the given date")
+		return
+
+	if args.format == "csv":
+		# stdout is written to, but not closed, as logging still writes to it
+		if not args.output:
+			write_forecast_csv(header, rows, sys.stdout)
+			return
+
+		with open(args.output, "w", newline="") as output:
+			write_forecast_csv(header, rows, output)
+	else:
+		widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+		for row in [header] + rows:
+			logger.info("  ".join(value.ljust(width) for value, width in zip(row, widths)))
 
 def remove_recurring_txn(args):
 	logger.info("Removing recurring transaction")
-	args.db.remove_recurring_transaction(args.id)
+	get_db(args).remove_recurring_transaction(args.id)
 
 def run_auto_processor(args):
+	from stages import Stage, run_stages, SUCCEEDED, UNCHANGED, LOCKED
+
 	logger.info("Starting run of the Budgeting Auto-Processor")
 
+	# started before anything else, so the whole run fits in the budget
+	deadline = util.Deadline(args.deadline)
+
 	creds = json.load(open(args.credentials_path))
 	config = json.load(open(args.config))
+	db = get_db(args)
 
-	mm = MonarchMoneyHelper(creds, args.db, args.mm_session_pickle_file)
+	# helpers are only built (and logged in) once a stage that needs them runs
+	def build_monarch():
+		from monarch_money_helper import MonarchMoneyHelper
+		return MonarchMoneyHelper(creds, db, args.mm_session_pickle_file, mirror=args.mm_mirror, deadline=deadline, cache_ttl=args.mm_cache_ttl)
 
-	if args.splitwise:
-		splitwise = SplitwiseHelper(creds, mm, args.shorthand_json_path, args.splitwise_user_id_to_name_json, args.custom_user_identifier, args.db)
+	def build_splitwise():
+		from splitwise_helper import SplitwiseHelper
+		return SplitwiseHelper(creds, monarch, args.shorthand_json_path, args.splitwise_user_id_to_name_json, args.custom_user_identifier, db, splitwise_client=args.splitwise_client, now=args.run_time, store=args.splitwise_store, deadline=deadline)
 
+	monarch = util.LazyValue(build_monarch)
+	splitwise = util.LazyValue(build_splitwise)
+
+	# Stages are listed in the order they used to run one after another. Each names the data
+	# it reads and writes, so stages only wait on the earlier stages whose writes they read.
+	stages = []
+
+	if args.splitwise:
 		# Process Splitwise expenses and add transactions to Monarch Money
-		splitwise.process_splitwise_expenses(args.splitwise_days_to_look_back)
+		stages.append(Stage("splitwise_expenses", lambda shard=None: splitwise.get().process_splitwise_expenses(args.splitwise_days_to_look_back, shard=shard),
+			inputs=["splitwise_expenses"], outputs=["monarch_transactions", "recurring_transactions"], sharded=True,
+			fingerprint=lambda: splitwise.get().expenses_fingerprint(args.splitwise_days_to_look_back)))
 
 		if 'payment_import_rules' in config:
-			splitwise.import_payments_from_budgeting_app(config['payment_import_rules'])
+			stages.append(Stage("splitwise_payments", lambda: splitwise.get().import_payments_from_budgeting_app(config['payment_import_rules']),
+				inputs=["monarch_transactions", "splitwise_expenses"], outputs=["splitwise_expenses"]))
 
 		if 'loans' in config:
-			splitwise.handle_personal_loans(config['loans'])
+			stages.append(Stage("splitwise_loans", lambda: splitwise.get().handle_personal_loans(config['loans']),
+				inputs=["splitwise_expenses"], outputs=["splitwise_expenses", "monarch_transactions"],
+				fingerprint=lambda: splitwise.get().personal_loans_fingerprint(config['loans'])))
 	else:
 		logger.info("Skipping Splitwise processing, as instructed")
 
 	if args.recategorize_txns and "patterns_to_recategorize" in config:
-		mm.recategorize_target_transactions(config["patterns_to_recategorize"])
+		stages.append(Stage("recategorize", lambda: monarch.get().recategorize_target_transactions(config["patterns_to_recategorize"]),
+			inputs=["monarch_transactions"], outputs=["monarch_transactions"]))
 
 	if args.recurring_txns:
 		# Add any recurring transactions to Monarch Money
-		mm.process_recurring_transactions()
+		stages.append(Stage("recurring", lambda shard=None: monarch.get().process_recurring_transactions(shard=shard),
+			inputs=["recurring_transactions"], outputs=["monarch_transactions", "recurring_transactions"], sharded=True))
 
-	if "account_balance_export_webhook" in config :
+	if "account_growth_partners" in config:
+		# Sync account growth between partner accounts
+		stages.append(Stage("account_growth", lambda: monarch.get().sync_account_growth(config["account_growth_partners"]),
+			inputs=["monarch_accounts"], outputs=["monarch_accounts"]))
+
+	if "account_balance_export_webhook" in config:
 		# Export account balances to the given webhook
-		mm.export_account_balances(config["account_balance_export_webhook"])
+		stages.append(Stage("balance_export", lambda: monarch.get().export_account_balances(config["account_balance_export_webhook"]),
+			inputs=["monarch_accounts"]))
+
+	if "budget_update_webhooks" in config:
+		stages.append(Stage("budget_sync", lambda: monarch.get().sync_budget_values_with_external_source(config["budget_update_webhooks"]),
+			outputs=["monarch_budgets"]))
 
 	if "auto_splits" in config:
-		# Process auto-splits
-		mm.handle_auto_splits(config["auto_splits"])
+		# Process auto-splits, once every stage creating or changing transactions is done
+		stages.append(Stage("auto_splits", lambda: monarch.get().handle_auto_splits(config["auto_splits"]),
+			inputs=["monarch_transactions", "monarch_budgets"], outputs=["monarch_transactions"],
+			fingerprint=lambda: monarch.get().auto_splits_fingerprint(config["auto_splits"]), refingerprint=True))
 
-	if "account_growth_partners" in config:
-		# Sync account growth between partner accounts
-		mm.sync_account_growth(config["account_growth_partners"])
+	statuses = run_stages(stages, args.stage_workers, db, profile=args.name, skip_unchanged=args.skip_unchanged, deadline=deadline, shards=args.shards)
 
-	if "budget_update_webhooks" in config:
-		mm.sync_budget_values_with_external_source(config["budget_update_webhooks"])
+	if monarch.built:
+		monarch.get().log_cache_stats()
+
+	unsuccessful = [name for name, status in statuses.items() if status not in (SUCCEEDED, UNCHANGED, LOCKED)]
+	if unsuccessful:
+		logger.error(f"Budgeting auto-processing finished, but these stages did not succeed: {unsuccessful}")
+		sys.exit(1)
 
 	logger.info("Budgeting auto-processing via Monarch Money complete!")
 
+def backfill_loans(args):
+	from monarch_money_helper import MonarchMoneyHelper
+	from splitwise_helper import SplitwiseHelper
+
+	today = date.today()
+	start_of_this_month = today.replace(day=1)
+	to_month = args.to_month or (start_of_this_month - timedelta(days=1)).replace(day=1)
+	if args.from_month > to_month or to_month >= start_of_this_month:
+		logger.error("ERROR: The months to backfill must be in order, and must have ended")
+		sys.exit(1)
+
+	months = [args.from_month]
+	while months[-1] < to_month:
+		months.append((months[-1] + timedelta(days=32)).replace(day=1))
+
+	creds = json.load(open(args.credentials_path))
+	loans = json.load(open(args.config)).get('loans', [])
+	if not loans:
+		logger.error(f"ERROR: No loans are configured in {args.config}")
+		sys.exit(1)
+
+	logger.info(f"Backfilling personal loan interest for {len(months)} months, from {months[0].strftime('%Y-%m')} to {months[-1].strftime('%Y-%m')}")
+
+	db = get_db(args)
+	monarch = MonarchMoneyHelper(creds, db, args.mm_session_pickle_file)
+	splitwise = SplitwiseHelper(creds, monarch, args.shorthand_json_path, args.splitwise_user_id_to_name_json, args.custom_user_identifier, db)
+	splitwise.handle_personal_loans(loans, months)
+
+def run_all_auto_processors(args):
+	logger.info("Starting multi-profile run of the Budgeting Auto-Processor")
+
+	from splitwise import Splitwise
+	from splitwise_helper import SharedSplitwise
+
+	profiles = json.load(open(args.profiles_path))
+	run_time = datetime.now()
+	dbs = {}
+
+	# Profiles that log into Splitwise with the same credentials share one client,
+	# so reads like the current user, friends and expenses are only fetched once
+	shared_clients = {}
+	profile_args_list = []
+	session_logins = {}
+	db_logins = {}
+	default_session_file = args.profile_parser.get_default("mm_session_pickle_file")
+	for profile in profiles:
+		profile_args = args.profile_parser.parse_args(profile['args'])
+		profile_args.name = profile['name']
+
+		# A Monarch session file holds one login's session, so each profile gets its own
+		# unless one is given. Profiles given the same file must log in as the same user.
+		if profile_args.mm_session_pickle_file == default_session_file:
+			root, ext = os.path.splitext(default_session_file)
+			profile_args.mm_session_pickle_file = f"{root}.{profile['name']}{ext}"
+
+		mm_login = json.load(open(profile_args.credentials_path))['mm']['email']
+		session_file = os.path.realpath(profile_args.mm_session_pickle_file)
+		if session_logins.setdefault(session_file, mm_login) != mm_login:
+			logger.error(f"ERROR: Profile \"{profile['name']}\" shares the Monarch Money session file {profile_args.mm_session_pickle_file} with a profile logging in as someone else. Give it its own --mm-session-pickle-file")
+			sys.exit(1)
+
+		# Recurring and scheduled transactions aren't kept per login, so likewise each
+		# profile gets its own DB unless one is given, and profiles sharing a DB must log in
+		# as the same user
+		if 'db_path' in profile:
+			profile_args.db_path = profile['db_path']
+		else:
+			root, ext = os.path.splitext(args.db_path)
+			profile_args.db_path = f"{root}.{profile['name']}{ext}"
+
+		if db_logins.setdefault(os.path.realpath(profile_args.db_path), mm_login) != mm_login:
+			logger.error(f"ERROR: Profile \"{profile['name']}\" shares the database {profile_args.db_path} with a profile logging in as someone else. Give it its own db_path")
+			sys.exit(1)
+
+		if profile_args.db_path not in dbs:
+			dbs[profile_args.db_path] = open_db(profile_args.db_path)
+		profile_args.db = dbs[profile_args.db_path]
+		profile_args.run_time = run_time
+
+		if profile_args.splitwise:
+			sw_creds = json.load(open(profile_args.credentials_path))['splitwise']
+			client_key = (sw_creds['consumer_key'], sw_creds['secret_key'], sw_creds['api_key'])
+			if client_key not in shared_clients:
+				shared_clients[client_key] = SharedSplitwise(Splitwise(sw_creds['consumer_key'], sw_creds['secret_key'], api_key=sw_creds['api_key']))
+			profile_args.splitwise_client = shared_clients[client_key]
+
+		profile_args_list.append(profile_args)
+
+	logger.info(f"Running {len(profile_args_list)} profiles with {args.workers} workers, sharing {len(shared_clients)} Splitwise clients")
+
+	failed_profiles = []
+	with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="profile") as executor:
+		futures = {executor.submit(run_auto_processor, profile_args): profile_args.name for profile_args in profile_args_list}
+		for future in as_completed(futures):
+			try:
+				future.result()
+				logger.info(f"Profile \"{futures[future]}\" complete")
+			except (Exception, SystemExit):
+				logger.exception(f"Profile \"{futures[future]}\" failed")
+				failed_profiles.append(futures[future])
+
+	if failed_profiles:
+		logger.error(f"Multi-profile run finished with failed profiles: {failed_profiles}")
+		sys.exit(1)
+
+	logger.info("Multi-profile auto-processing complete!")
+
 if __name__ == "__main__":
 
 	mint_wizard_dir = os.path.dirname(os.path.realpath(__file__))
 
 	parser = argparse.ArgumentParser()
-	parser.add_argument("-db", "--db-path", help="The path to the sqlite database file", default=f"{mint_wizard_dir}/mint-wizard.db", type=(lambda db_path: Db(db_path)), dest="db")
+	parser.add_argument("-db", "--db-path", help="The path to the sqlite database file", default=f"{mint_wizard_dir}/mint-wizard.db")
+	parser.set_defaults(db=None)
 	parser.add_argument("-v", "--verbose", help="Display debug logs", action='store_true')
+	parser.add_argument("--json-logs", help="Write logs as JSON lines", action='store_true')
 	subparsers = parser.add_subparsers(required=True)
 
 	auto_process_parser = subparsers.add_parser("auto-process", help="Run the auto-processor")
@@ -135,7 +429,33 @@ if __name__ == "__main__":
 	auto_process_parser.add_argument("--recategorize-txns", help="Perform transaction recategorization", action=argparse.BooleanOptionalAction, default=True)
 	auto_process_parser.add_argument("--splitwise", help="Process splitwise transactions", action=argparse.BooleanOptionalAction, default=True)	
 	auto_process_parser.add_argument("--mm-session-pickle-file", help="The file to save cookies and auth tokens to for Monarch Money", default=f"{mint_wizard_dir}/mm_session.pickle")
-	auto_process_parser.set_defaults(func=run_auto_processor)
+	auto_process_parser.add_argument("--mm-mirror", help="Keep a local mirror of Monarch Money transactions in the DB, and search it instead of Monarch. See README", action='store_true')
+	auto_process_parser.add_argument("--mm-cache-ttl", help="Re-fetch cached Monarch Money reads once they're this old, e.g. \"5m\". By default, reads are cached until something the run writes changes them. See README", type=util.str_to_seconds)
+	auto_process_parser.add_argument("--splitwise-store", help="Keep a local store of Splitwise expenses in the DB, and query it instead of Splitwise. See README", action='store_true')
+	auto_process_parser.add_argument("--stage-workers", help="The number of independent stages to run at the same time", type=int, default=4)
+	auto_process_parser.add_argument("--deadline", help="The time the run may take, e.g. \"10m\". Stages still running when it's up stop where the next run can pick up from", type=util.str_to_seconds)
+	auto_process_parser.add_argument("--shards", help="The number of shards to split the recurring transaction and Splitwise expense stages into, so several processes sharing the DB can split that work. See README", type=int, default=1)
+	auto_process_parser.add_argument("--skip-unchanged", help="Skip stages whose inputs haven't changed since their last successful run", action=argparse.BooleanOptionalAction, default=True)
+	auto_process_parser.set_defaults(func=run_auto_processor, splitwise_client=None, run_time=None, name=None)
+
+	auto_process_all_parser = subparsers.add_parser("auto-process-all", help="Run the auto-processor for several profiles in one process, sharing Splitwise reads between them")
+	auto_process_all_parser.add_argument("-profiles", "--profiles-path", help="The path to a JSON list of profiles. Each profile has a \"name\", the \"args\" it would pass to auto-process, and an optional \"db_path\". See README", required=True)
+	auto_process_all_parser.add_argument("-w", "--workers", help="The number of profiles to run at the same time", type=int, default=4)
+	auto_process_all_parser.set_defaults(func=run_all_auto_processors, profile_parser=auto_process_parser)
+
+	loans_subparser = subparsers.add_parser("loans", help="Manage personal loans")
+	loans_subparsers = loans_subparser.add_subparsers(required=True)
+
+	backfill_loans_parser = loans_subparsers.add_parser("backfill", help="Charge the personal loan interest, and record the loan payments, for months that were missed. See README")
+	backfill_loans_parser.add_argument("--from", help="The first month to backfill, in YYYY-MM format", dest="from_month", required=True, type=util.str_to_month)
+	backfill_loans_parser.add_argument("--to", help="The last month to backfill, in YYYY-MM format. Defaults to last month", dest="to_month", type=util.str_to_month)
+	backfill_loans_parser.add_argument("-creds", "--credentials-path", help="The path to the file containing your credentials", required=True)
+	backfill_loans_parser.add_argument("-config", help="Path to config file with the loans", default=f"{mint_wizard_dir}/config.json")
+	backfill_loans_parser.add_argument("-short", "--shorthand-json-path", help="The path to the file containing the mapping of shorthand identifiers to categories", default=f"{mint_wizard_dir}/shorthands.json")
+	backfill_loans_parser.add_argument("-names", "--splitwise-user-id-to-name-json", help="The path of the JSON file used to override names fetched from Splitwise")
+	backfill_loans_parser.add_argument("-userid", "--custom-user-identifier", help="Turns on user-specific Splitwise flags. See README")
+	backfill_loans_parser.add_argument("--mm-session-pickle-file", help="The file to save cookies and auth tokens to for Monarch Money", default=f"{mint_wizard_dir}/mm_session.pickle")
+	backfill_loans_parser.set_defaults(func=backfill_loans)
 
 	recurring_transactions_subparser = subparsers.add_parser("recurring-txns", help="Configure recurring transactions")
 	recurring_transactions_subparsers = recurring_transactions_subparser.add_subparsers(required=True)
@@ -151,6 +471,24 @@ if __name__ == "__main__":
 	add_recurring_txn_parser.add_argument("-mc", "--move-from-category", help="Category to move the transaction FROM. This will create two recurring transactions: one credit to the FROM category, and one charge to the -c category")
 	add_recurring_txn_parser.set_defaults(func=add_recurring_txn)
 
+	import_recurring_txns_parser = recurring_transactions_subparsers.add_parser("import", help="Add recurring transactions in bulk from a CSV or JSON file. See README")
+	import_recurring_txns_parser.add_argument("path", help="The CSV or JSON file to import")
+	import_recurring_txns_parser.add_argument("-short", "--shorthand-json-path", help="The path to the file containing the mapping of shorthand identifiers to categories", default=f"{mint_wizard_dir}/shorthands.json")
+	import_recurring_txns_parser.add_argument("-w", "--workers", help="The number of processes to parse recurrence rules with. Defaults to the number of CPUs", type=int)
+	import_recurring_txns_parser.set_defaults(func=import_recurring_txns)
+
+	export_recurring_txns_parser = recurring_transactions_subparsers.add_parser("export", help="Export the recurring transactions as CSV or JSON")
+	export_recurring_txns_parser.add_argument("--format", help="The format to export in", choices=["csv", "json"], default="csv")
+	export_recurring_txns_parser.add_argument("-o", "--output", help="File to write the export to, instead of printing it")
+	export_recurring_txns_parser.set_defaults(func=export_recurring_txns)
+
+	forecast_recurring_txns_parser = recurring_transactions_subparsers.add_parser("forecast", help="Total up the amounts the recurring transactions will create, per category and month")
+	forecast_recurring_txns_parser.add_argument("--until", help="The last date to forecast, in YYYY-MM-DD format", required=True, type=date.fromisoformat)
+	forecast_recurring_txns_parser.add_argument("--by", help="Total over just categories or just months, instead of each category per month", choices=["category", "month"])
+	forecast_recurring_txns_parser.add_argument("--format", help="Print the forecast as an aligned table or as CSV", choices=["table", "csv"], default="table")
+	forecast_recurring_txns_parser.add_argument("-o", "--output", help="File to write the CSV forecast to, instead of printing it")
+	forecast_recurring_txns_parser.set_defaults(func=forecast_recurring_txns)
+
 	remove_recurring_txn_parser = recurring_transactions_subparsers.add_parser("remove", help="Remove a recurring transaction")
 	remove_recurring_txn_parser.add_argument("-id", required=True)
 	remove_recurring_txn_parser.set_defaults(func=remove_recurring_txn)
@@ -162,8 +500,11 @@ if __name__ == "__main__":
 		root_logger.setLevel(logging.DEBUG)
 		for handler in root_logger.handlers:
 			handler.setLevel(logging.DEBUG)
-		logger.debug("Verbose logging enabled")
 
-	logger.debug(f"Args parsed: {args}")
+	# records are written by a background thread from here on
+	util.start_queue_logging(args.json_logs)
+	logger.debug("Verbose logging enabled")
+
+	logger.debug("Args parsed: %s", args)
 
 	args.func(args)
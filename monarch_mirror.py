@@ -0,0 +1,95 @@
+import logging
+import threading
+
+from datetime import date, datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Incremental syncs re-fetch every transaction dated this many days before the previous
+# sync, which picks up new, edited and deleted transactions in that window. It covers all
+# of last month, which auto-splits look back over. Changes to older transactions are
+# picked up by the periodic full sync.
+SYNC_LOOKBACK_DAYS = 62
+FULL_SYNC_INTERVAL_DAYS = 7
+
+# transactions can be dated in the future (e.g. Splitwise expenses), so the sync window
+# extends this far past today
+SYNC_LOOKAHEAD_DAYS = 365
+
+# MonarchMoney.get_transactions returns at most this many transactions by default
+DEFAULT_SEARCH_LIMIT = 100
+
+SEARCH_FILTERS = {"search", "start_date", "end_date", "category_ids", "account_ids", "is_split", "limit", "offset"}
+
+# A local copy of a Monarch Money login's transactions, stored in the DB, so transaction
+# searches can run locally instead of against Monarch's search endpoint.
+#
+# The mirror is synced before the first search of each run. Transactions written by this
+# script are recorded in the mirror as they're written, so later searches in the same run
+# see them.
+class MonarchMirror:
+	def __init__(self, db, owner, iter_transactions):
+		self.db = db
+		self.owner = owner
+		self.iter_transactions = iter_transactions
+		self.state_key = f"monarch_mirror:{owner}"
+
+		self.sync_lock = threading.Lock()
+		self.synced = False
+
+	# whether the mirror can answer a search with the given MonarchMoney.get_transactions filters
+	def supports(self, filters):
+		return set(filters) <= SEARCH_FILTERS
+
+	def search(self, limit=DEFAULT_SEARCH_LIMIT, **filters):
+		self.ensure_synced()
+		return self.db.search_monarch_transactions(self.owner, limit=limit, **filters)
+
+	def count(self, limit=None, offset=None, **filters):
+		self.ensure_synced()
+		return self.db.count_monarch_transactions(self.owner, **filters)
+
+	def ensure_synced(self):
+		with self.sync_lock:
+			if not self.synced:
+				self.sync()
+				self.synced = True
+
+	def sync(self):
+		now = datetime.now()
+		state = self.db.get_state(self.state_key)
+
+		if state is None or now - datetime.fromisoformat(state['full_synced_at']) >= timedelta(days=FULL_SYNC_INTERVAL_DAYS):
+			logger.info("Fully syncing the local mirror of Monarch Money transactions...")
+			start_date = end_date = None
+			txns = list(self.iter_transactions())
+			full_synced_at = now
+		else:
+			start_date = (datetime.fromisoformat(state['synced_at']).date() - timedelta(days=SYNC_LOOKBACK_DAYS)).isoformat()
+			end_date = (date.today() + timedelta(days=SYNC_LOOKAHEAD_DAYS)).isoformat()
+			logger.info(f"Syncing the local mirror of Monarch Money transactions dated from {start_date}...")
+			txns = list(self.iter_transactions(start_date=start_date, end_date=end_date))
+			full_synced_at = datetime.fromisoformat(state['full_synced_at'])
+
+		# everything is fetched before writing, so the DB isn't locked while waiting on Monarch.
+		# The sync is committed on its own, as it's only made once a run.
+		with self.db.unit_of_work(separate=True):
+			known_versions = self.db.get_monarch_transaction_versions(self.owner, start_date, end_date)
+
+			changed = [txn for txn in txns if known_versions.get(txn['id']) != txn['updatedAt']]
+			removed = set(known_versions) - {txn['id'] for txn in txns}
+
+			self.db.upsert_monarch_transactions(self.owner, changed)
+			self.db.delete_monarch_transactions(self.owner, removed)
+			self.db.set_state(self.state_key, {'synced_at': now.isoformat(), 'full_synced_at': full_synced_at.isoformat()})
+
+		logger.info(f"Mirror synced: {len(txns)} transactions fetched, {len(changed)} new or updated, {len(removed)} removed")
+
+	# Records transactions created or changed by this script. They're stored without an
+	# update time, so the next sync replaces them with Monarch's copy.
+	def record(self, txns):
+		self.db.upsert_monarch_transactions(self.owner, [dict(txn, updatedAt="") for txn in txns])
+
+	# Drops transactions whose new state isn't known (e.g. after splitting them) until the next sync
+	def discard(self, ids):
+		self.db.delete_monarch_transactions(self.owner, ids)
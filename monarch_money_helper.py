@@ -1,63 +1,134 @@
-import pyotp
+import os
+import re
 import sys
 import asyncio
 import logging
 import requests
+import threading
+import util
+import leases
+import records
 
 from requests.models import PreparedRequest
 
 from decimal import Decimal
-from db import get_next_occurrence_for_txn
-from monarchmoney import MonarchMoney, RequireMFAException
+from monarchmoney import MonarchMoney
+from gql.transport.exceptions import TransportServerError
 from datetime import datetime, timedelta, date
 
 logger = logging.getLogger(__name__)
 logging.getLogger('gql.transport.aiohttp').setLevel(logging.WARN)
 
+TRANSACTION_PAGE_SIZE = 500
+MAX_CONCURRENT_WRITES = 8
+
+# Transactions can be imported from a bank with a date well before the day they show up
+# in Monarch, so incremental scans start this many days before the last scanned transaction.
+# Older history (e.g. backfilled by a newly linked account) is picked up by the full scan
+# made whenever the set of accounts changes.
+RECATEGORIZE_LOOKBACK_DAYS = 14
+
+# Monarch doesn't say when sessions expire, so they're replaced once they reach this age,
+# before Monarch starts rejecting them
+SESSION_REFRESH_AGE = timedelta(days=14)
+
+# webhook calls time out after this many seconds, or sooner if the run deadline is closer
+WEBHOOK_TIMEOUT = 60
+
+# The groups of Monarch Money data cached by the run's read cache. A write invalidates the
+# reads of the data it changes.
+TRANSACTIONS = "transactions"
+BUDGETS = "budgets"
+ACCOUNTS = "accounts"
+
+# Combines all patterns into a single regex, so each string is only matched once no matter
+# how many patterns there are. Each pattern sits in a lookahead followed by an empty named
+# group, so the first pattern (in config order) that matches anywhere in the string wins,
+# just like trying the patterns one after another.
+#
+# Returns a function mapping a string to the index of the first matching pattern, or None.
+def build_pattern_matcher(patterns):
+    compiled = [re.compile(pattern) for pattern in patterns]
+    match_individually = lambda string: next((i for i, pattern in enumerate(compiled) if pattern.search(string)), None)
+
+    # combining renumbers the patterns' groups, which would break their backreferences
+    if any(pattern.groups for pattern in compiled):
+        logger.info("Recategorization patterns have capturing groups; matching them individually")
+        return match_individually
+
+    try:
+        combined = re.compile("|".join(f"(?=[\\s\\S]*?(?:{pattern}))(?P<pattern{i}>)" for i, pattern in enumerate(patterns)))
+    except re.error:
+        # patterns using features that can't be combined (inline flags) are matched one at a
+        # time instead
+        logger.warning("Recategorization patterns could not be combined; matching them individually")
+        return match_individually
+
+    def match(string):
+        m = combined.match(string)
+        return int(m.lastgroup[len("pattern"):]) if m else None
+
+    return match
+
+# The (start, end) dates of last month and this month, which auto-splits are applied to
+def auto_split_date_ranges():
+    today = date.today()
+    start_of_last_month = (today - timedelta(days=today.day)).replace(day=1)
+    end_of_last_month = today - timedelta(days=today.day)
+
+    start_of_this_month = today.replace(day=1)
+    next_month_sometime = today.replace(day=28) + timedelta(days=4)
+    end_of_this_month = next_month_sometime - timedelta(days=next_month_sometime.day)
+
+    return [(start_of_last_month, end_of_last_month), (start_of_this_month, end_of_this_month)]
+
 class MonarchMoneyHelper:
-    def __init__(self, creds, db, session_file):
+    def __init__(self, creds, db, session_file, mirror=False, deadline=None, cache_ttl=None):
         self.creds = creds
         self.db = db
+        self.deadline = deadline or util.Deadline()
 
-        self.mm = MonarchMoney(session_file = session_file)
+        # reads repeated by different stages only go to Monarch once, until a write changes
+        # what they read (or, with a TTL, until they're that old)
+        self.cache = util.ReadCache(cache_ttl)
 
-        # login
-        logger.info("Logging in...")
-        try:
-            asyncio.run(self.mm.login(creds['mm']['email'], creds['mm']['password']))
-        except RequireMFAException:
-            logger.debug("Providing TOTP...")
-            asyncio.run(self.mm.multi_factor_authenticate(
-                creds['mm']['email'], creds['mm']['password'], pyotp.TOTP(creds['mm']['totp_secret']).now()
-            ))
-            self.mm.save_session()
-        except Exception:
-            logger.warning(
-                "Failed to login with saved session. Logging in with new session."
-            )
+        # searches go to a local mirror of the transactions, if enabled
+        self.mirror = None
+        if mirror:
+            from monarch_mirror import MonarchMirror
+            self.mirror = MonarchMirror(db, creds['mm']['email'], self.iter_transactions)
 
+        self.mm = MonarchMoney(session_file = session_file)
+        self.session_file = session_file
+        self.session_state_key = f"monarch_session:{creds['mm']['email']}"
+        self.recategorize_state_key = f"recategorize_watermark:{creds['mm']['email']}"
+
+        # incremented on each login, so concurrent callers rejected by the same stale
+        # session only log in once between them
+        self.session_lock = threading.Lock()
+        self.session_generation = 0
+
+        # The saved session is used without checking it first: the first request below
+        # doubles as the check, and logs in again only if the session is rejected
+        session = self.db.get_state(self.session_state_key)
+        if not os.path.exists(session_file):
+            logger.info("No saved session found. Logging in...")
             self.refresh_login()
-
-            logger.warning("New session successful")
-
-        # Set up "Automated Transactions" account, if not present
-        logger.info("Fetching accounts...")
-        try:
-            result = asyncio.run(self.mm.get_accounts())
-        except Exception:
-            logger.warning(
-                "Failed to fetch accounts... Trying to log in with new session."
-            )
-
+        elif session and datetime.fromisoformat(session['expires_at']) <= datetime.now():
+            logger.info("Saved session is due to expire. Logging in...")
             self.refresh_login()
+        else:
+            logger.info("Using saved session")
+            self.mm.load_session(session_file)
 
-            result = asyncio.run(self.mm.get_accounts())
-
-            logger.warning("New session successful")
-
+        # Set up "Automated Transactions" account, if not present. This is the run's only
+        # account fetch: the balances it returns are recorded for the stages that need them.
+        logger.info("Fetching accounts...")
+        result = self.read(ACCOUNTS, self.mm.get_accounts)
+        self.accounts = result['accounts']
 
         self.account_map = {}
-        for account in result['accounts']:
+        for account in self.accounts:
             if account['displayName'] in self.account_map:
                 if account['displayName'] == "Automated Transactions":
                     logger.error("More than one account exists with the name 'Automated Transactions'. Please rename extra accounts with that name.")
@@ -67,7 +138,9 @@ class MonarchMoneyHelper:
 
             self.account_map[account['displayName']] = account['id']
 
-        logger.debug(f"Accounts fetched: {self.account_map}")
+        logger.debug("Accounts fetched: %s", self.account_map)
+
+        self.db.record_account_balances({account['id']: account['currentBalance'] for account in self.accounts}, date.today())
 
         if "Automated Transactions" not in self.account_map:
             # TODO: set up account automatically
@@ -81,18 +154,18 @@ class MonarchMoneyHelper:
         # Set up the category map
         logger.info("Fetching categories and setting up category -> id map...")
         self.category_map = {}
-        result = asyncio.run(self.mm.get_transaction_categories())
+        result = self.run(self.mm.get_transaction_categories)
         for category in result['categories']:
             if category['name'] in self.category_map:
                 logger.error(f"Multiple categories with name '{category['name']}' exist. This may result in unintended behavior.")
 
             self.category_map[category['name']] = category['id']
 
-        logger.debug(f"Categories fetched: {self.category_map}")
+        logger.debug("Categories fetched: %s", self.category_map)
 
         # Set up the required tag(s), if not yet created
         logger.info("Fetching 'AUTOPROCESSED' tag...")
-        result = asyncio.run(self.mm.get_transaction_tags())
+        result = self.run(self.mm.get_transaction_tags)
         filtered_tags = list(filter(lambda tag: tag['name'] == "AUTOPROCESSED", result['householdTransactionTags']))
 
         if len(filtered_tags) == 0:
@@ -105,144 +178,329 @@ class MonarchMoneyHelper:
         else:
             self.autoprocessed_tag_id = filtered_tags[0]['id']
 
-        logger.debug(f"AUTOPROCESSED tag fetched: {filtered_tags[0]}")
+        logger.debug("AUTOPROCESSED tag fetched: %s", filtered_tags[0])
+
+    # Logs in with the credentials (and TOTP secret), saving the new session. If `generation`
+    # is given and another caller has logged in since then, its session is used instead.
+    def refresh_login(self, generation=None):
+        with self.session_lock:
+            if generation is not None and generation != self.session_generation:
+                return
+
+            self.mm._headers.pop("Authorization", None)
+            self.run_before_deadline(self.mm.login(self.creds['mm']['email'], self.creds['mm']['password'], mfa_secret_key = self.creds['mm']['totp_secret'], use_saved_session=False))
+            self.session_generation += 1
+
+            now = datetime.now()
+            self.db.set_state(self.session_state_key, {'created_at': now.isoformat(), 'expires_at': (now + SESSION_REFRESH_AGE).isoformat()})
+
+            logger.info("Logged in with new session")
 
-    def refresh_login(self):
-        del self.mm._headers["Authorization"]
-        asyncio.run(self.mm.login(self.creds['mm']['email'], self.creds['mm']['password'], mfa_secret_key = self.creds['mm']['totp_secret'], use_saved_session=False))
-        self.mm.save_session()
+    # Runs a MonarchMoney API method. If the session is rejected, logs in again (once, however
+    # many callers were rejected) and retries.
+    def run(self, method, *args, **kwargs):
+        generation = self.session_generation
+        try:
+            return self.run_before_deadline(method(*args, **kwargs))
+        except TransportServerError as e:
+            if e.code not in (401, 403):
+                raise
+
+            logger.warning(f"Session was rejected (HTTP {e.code}). Logging in again...")
+            self.refresh_login(generation)
+            return self.run_before_deadline(method(*args, **kwargs))
+
+    # Runs a MonarchMoney read method through the read cache. `group` is the data it reads.
+    def read(self, group, method, *args, **kwargs):
+        return self.cache.get(group, [method.__name__, args, kwargs], lambda: self.run(method, *args, **kwargs))
+
+    # Runs a MonarchMoney write method, invalidating the cached reads of the data in `groups`.
+    # They're invalidated even if the write fails, as it may have been applied anyway.
+    def write(self, groups, method, *args, **kwargs):
+        try:
+            return self.run(method, *args, **kwargs)
+        finally:
+            self.cache.invalidate(*groups)
+
+    def log_cache_stats(self):
+        logger.info("Monarch Money read cache: %s hits, %s misses", self.cache.hits, self.cache.misses)
+
+    # Runs a coroutine, cancelling it if the run deadline passes first
+    def run_before_deadline(self, coroutine):
+        try:
+            timeout = self.deadline.timeout()
+        except util.DeadlineExceeded:
+            coroutine.close()
+            raise
+
+        try:
+            return asyncio.run(asyncio.wait_for(coroutine, timeout))
+        except asyncio.TimeoutError as e:
+            if self.deadline.expired():
+                raise util.DeadlineExceeded("The run deadline was reached during a Monarch Money request") from e
+            raise
 
     # returns True if a transaction either was created or already existed
     def add_transaction(self, desc, price, category, date, dedupe, notes=""):
         price = Decimal(price)
 
         if price == 0:
-            logger.warn("Given transaction %s has a value of 0. Skipping, and treating the transaction as created..." % (desc))
+            logger.warning("Given transaction %s has a value of 0. Skipping, and treating the transaction as created...", desc)
             return True
 
-        dedupe_results = asyncio.run(self.mm.get_transactions(search = dedupe))
-        if dedupe_results['allTransactions']['totalCount'] > 0:
-            logger.info("Duplicate found: %s (dedupe string: %s). Skipping..." % (desc, dedupe))
+        if self.count_transactions(search = dedupe) > 0:
+            logger.info("Duplicate found: %s (dedupe string: %s). Skipping...", desc, dedupe)
             return True
 
         if category not in self.category_map:
             logger.error(f"Given category '{category}' does not exist in the user's account. Skipping...")
             return False
 
-        logger.info("Adding transaction for \"%s\" with price $%s and category \"%s\"" % (desc, price, category))
+        logger.info("Adding transaction for \"%s\" with price $%s and category \"%s\"", desc, price, category)
 
-        asyncio.run(self.mm.create_transaction(
+        notes = dedupe if (notes == None or len(str(notes).strip()) == 0) else f"{notes}\n\nDEDUPE: {dedupe}"
+        result = self.write([TRANSACTIONS], self.mm.create_transaction,
             date.strftime("%Y-%m-%d"),
             self.automated_account_id,
             float(price),
             desc,
             self.category_map[category],
-            dedupe if (notes == None or len(str(notes).strip()) == 0) else f"{notes}\n\nDEDUPE: {dedupe}"))
+            notes)
+
+        if self.mirror:
+            self.mirror.record([{
+                "id": result['createTransaction']['transaction']['id'],
+                "date": date.strftime("%Y-%m-%d"),
+                "amount": float(price),
+                "notes": notes,
+                "plaidName": None,
+                "isSplitTransaction": False,
+                "category": {"id": self.category_map[category], "name": category},
+                "merchant": {"name": desc},
+                "account": {"id": self.automated_account_id, "displayName": "Automated Transactions"},
+                "tags": []
+            }])
 
         return True
 
+    # Takes the same filters as MonarchMoney.get_transactions. Searches the local mirror
+    # instead, if enabled.
     def search_transactions(self, **kwargs):
-        return asyncio.run(self.mm.get_transactions(**kwargs))['allTransactions']['results']
+        if self.mirror and self.mirror.supports(kwargs):
+            return self.mirror.search(**kwargs)
+
+        return self.read(TRANSACTIONS, self.mm.get_transactions, **kwargs)['allTransactions']['results']
+
+    def count_transactions(self, **kwargs):
+        if self.mirror and self.mirror.supports(kwargs):
+            return self.mirror.count(**kwargs)
+
+        return self.read(TRANSACTIONS, self.mm.get_transactions, limit=1, **kwargs)['allTransactions']['totalCount']
 
     def get_budgets(self, **kwargs):
-        return asyncio.run(self.mm.get_budgets(**kwargs))['budgetData']['monthlyAmountsByCategory']
+        return self.read(BUDGETS, self.mm.get_budgets, **kwargs)['budgetData']['monthlyAmountsByCategory']
 
-    def recategorize_txn(self, txn, category, description=False, set_as_autoprocessed=True):
-        raise NotImplementedError
+    # Pages through every transaction matching the given filters. Pages aren't cached, as
+    # full scans are only made once a run and would hold every transaction in memory.
+    def iter_transactions(self, **kwargs):
+        offset = 0
+        while True:
+            page = self.run(self.mm.get_transactions, limit=TRANSACTION_PAGE_SIZE, offset=offset, **kwargs)['allTransactions']
+            yield from page['results']
 
-    def tag_txn(self, txn, tag):
-        raise NotImplementedError
+            offset += len(page['results'])
+            if len(page['results']) == 0 or offset >= page['totalCount']:
+                return
 
+    def recategorize_txn(self, txn, category, description=None, set_as_autoprocessed=True):
+        self.recategorize_all_txns([(txn, category, description)], set_as_autoprocessed)
 
-    def recategorize_all_txns(self, txns, category, set_as_autoprocessed=True):
-        for txn in txns:
-            self.recategorize_txn(txn, category, set_as_autoprocessed)
+    def tag_txn(self, txn, tag_id):
+        self.write([TRANSACTIONS], self.mm.set_transaction_tags, txn['id'], [tag['id'] for tag in txn['tags']] + [tag_id])
+
+    # applies a batch of (txn, category, description) updates concurrently; returns the updates that failed
+    def recategorize_all_txns(self, updates, set_as_autoprocessed=True):
+        async def apply_all():
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_WRITES)
+
+            async def apply(txn, category, description):
+                async with semaphore:
+                    await self.mm.update_transaction(txn['id'], category_id=self.category_map[category], merchant_name=description)
+                    if set_as_autoprocessed:
+                        await self.mm.set_transaction_tags(txn['id'], [tag['id'] for tag in txn['tags']] + [self.autoprocessed_tag_id])
+
+            return await asyncio.gather(*(apply(*update) for update in updates), return_exceptions=True)
+
+        try:
+            results = self.run_before_deadline(apply_all())
+        finally:
+            self.cache.invalidate(TRANSACTIONS)
+
+        failed = []
+        succeeded = []
+        for update, result in zip(updates, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to recategorize transaction {update[0]['id']}: {result}")
+                failed.append(update)
+            else:
+                succeeded.append(update)
+
+        if self.mirror:
+            self.mirror.record([dict(txn,
+                category={"id": self.category_map[category], "name": category},
+                merchant=dict(txn['merchant'], name=description) if description else txn['merchant'],
+                tags=txn['tags'] + [{"id": self.autoprocessed_tag_id, "name": "AUTOPROCESSED"}] if set_as_autoprocessed else txn['tags'])
+                for txn, category, description in succeeded])
 
+        return failed
 
     def get_txn_statement_name(self, txn):
-        raise NotImplementedError
-        return txn.get_attribute("title")[len("Statement Name: "):]
+        return txn['plaidName'] or txn['merchant']['name']
 
     def recategorize_target_transactions(self, pattern_configs):
-        raise NotImplementedError
         logger.info("Starting to recategorize target transactions by pattern")
 
-        self.wait_for_transaction_table(hide_autoprocessed=True)
-
+        valid_pattern_configs = []
         for pattern, category, new_description in pattern_configs:
-            logger.info("Processing pattern /%s/; recategorizing matches to \"%s\" with new description \"%s\"" % (pattern, category, new_description))
+            if category not in self.category_map:
+                logger.error(f"Category '{category}' for pattern /{pattern}/ does not exist in the user's account. Skipping pattern...")
+                continue
 
-            txns = self.get_all_transactions()
-            txns.reverse()
+            valid_pattern_configs.append((pattern, category, new_description))
 
-            txns = list(filter(lambda txn: re.search(pattern, self.get_txn_statement_name(txn)), txns))
+        pattern_configs = valid_pattern_configs
+        if len(pattern_configs) == 0:
+            return
 
-            logger.info("%s matches found for pattern" % len(txns))
-            for txn in txns:
-                statement_name = self.get_txn_statement_name(txn)
-                if "AUTOCATEGORIZED" in statement_name:
-                    logger.info("Skipping matching transaction \"%s\" as it's already auto-categorized" % statement_name.replace(" | AUTOCATEGORIZED", "").strip())
-                    continue
+        match = build_pattern_matcher([pattern for pattern, _, _ in pattern_configs])
+
+        # only scan transactions that arrived since the last run, unless the patterns or the
+        # accounts changed
+        patterns_fingerprint = util.fingerprint(pattern_configs)
+        accounts_fingerprint = util.fingerprint(sorted(account['id'] for account in self.accounts))
+        watermark = self.db.get_state(self.recategorize_state_key)
+        if watermark and watermark['patterns'] == patterns_fingerprint and watermark.get('accounts') == accounts_fingerprint:
+            scan_start = date.fromisoformat(watermark['created_at'][:10]) - timedelta(days=RECATEGORIZE_LOOKBACK_DAYS)
+            logger.info(f"Scanning transactions created after {watermark['created_at']}")
+            txns = self.iter_transactions(start_date=scan_start.isoformat(), end_date=date.today().isoformat())
+            last_created_at = watermark['created_at']
+        else:
+            logger.info("Patterns or accounts changed, or no previous scan found; scanning all transactions")
+            txns = self.iter_transactions()
+            last_created_at = ""
+
+        scanned = 0
+        updates = []
+        newest_created_at = last_created_at
+        for txn in txns:
+            if txn['createdAt'] <= last_created_at:
+                continue
+
+            scanned += 1
+            newest_created_at = max(newest_created_at, txn['createdAt'])
+
+            pattern_index = match(self.get_txn_statement_name(txn))
+            if pattern_index is None:
+                continue
 
-                logger.info("Renaming matching transaction \"%s\" to \"%s\", and recategorizing as \"%s\"" % (statement_name, new_description, category))
-                self.recategorize_txn(txn, category, description="%s | AUTOCATEGORIZED" % new_description)
-                logger.info("Transaction recategorized")
+            pattern, category, new_description = pattern_configs[pattern_index]
+            if any(tag['id'] == self.autoprocessed_tag_id for tag in txn['tags']):
+                logger.info("Skipping matching transaction \"%s\" as it's already auto-processed", txn['merchant']['name'])
+                continue
 
-    def process_recurring_transactions(self):
+            logger.info("Renaming transaction \"%s\" matching /%s/ to \"%s\", and recategorizing as \"%s\"", self.get_txn_statement_name(txn), pattern, new_description, category)
+            updates.append((txn, category, new_description))
+
+        logger.info(f"{scanned} new transactions scanned; {len(updates)} to recategorize")
+
+        failed = self.recategorize_all_txns(updates)
+
+        # leave the watermark alone on failure, so the failed transactions are picked up again next run
+        if failed:
+            logger.error(f"{len(failed)} transactions failed to recategorize")
+        else:
+            self.db.set_state(self.recategorize_state_key, {'patterns': patterns_fingerprint, 'accounts': accounts_fingerprint, 'created_at': newest_created_at})
+            logger.info("Transactions recategorized")
+
+    # `shard` is an (index, count) pair limiting the transactions processed, so several
+    # processes can split them (see stages.py)
+    def process_recurring_transactions(self, shard=None):
         logger.info("Processing recurring transactions")
 
-        txns = self.db.get_past_due_recurring_transactions()
+        txns = self.db.get_past_due_recurring_transactions(shard=shard)
         logger.info("%s recurring transactions to process in first iteration" % len(txns))
         skipped_ids = set()
         while txns:
-            for txn in txns:
-                logger.info("Creating transaction for \"%s\"" % txn)
+            # each completion is committed on its own, so the DB isn't held locked while
+            # waiting on Monarch
+            for txn, next_occurrence in txns:
+                if self.deadline.expired():
+                    break
+                leases.check_lease()
+
+                logger.info("Creating transaction for \"%s\"", txn)
 
-                next_occurrence = get_next_occurrence_for_txn(txn)
                 if self.add_transaction(txn.description, txn.amount, txn.category, next_occurrence, "RECUR:%s:%s" % (txn.dedupe_string, next_occurrence.isoformat()), notes=txn.notes):
-                    # only run the completion logic if the transaction now exists
-                    self.db.process_recurring_transaction_completion(txn.id)
+                    # only run the completion logic if the transaction now exists. It's
+                    # conditional on the occurrence not having been completed elsewhere
+                    # since it was read.
+                    self.db.process_recurring_transaction_completion(txn.id, next_occurrence, expected_previous_occurrence=txn.previous_occurrence)
                 else:
                     skipped_ids.add(txn.id)
 
-            txns = self.db.get_past_due_recurring_transactions(exclude_ids=skipped_ids)
+            # the completions so far are committed, so the next run carries on from here. The
+            # stage is marked stopped, rather than succeeded.
+            if self.deadline.expired():
+                raise util.DeadlineExceeded("Run deadline reached. The remaining recurring transactions will be created next run")
+
+            txns = self.db.get_past_due_recurring_transactions(exclude_ids=skipped_ids, shard=shard)
             logger.info("%s recurring transactions to process in next iteration" % len(txns))
 
     def export_account_balances(self, webhook):
         logger.info("Starting account balance export")
 
-        # fetch all account balances
-        accounts = asyncio.run(self.mm.get_accounts())
-        extra_params = {account['displayName']: account['currentBalance'] for account in accounts['accounts']}
+        # the account balances fetched at the start of the run, plus any changes made since
+        extra_params = {account['displayName']: account['currentBalance'] for account in self.accounts}
 
         # aggregate all cost basis for taxable brokerage accounts
-        brokerages = list(filter(lambda account: account['subtype']['display'] == "Brokerage (Taxable)" and not account['isHidden'], accounts['accounts']))
+        brokerages = list(filter(lambda account: account['subtype']['display'] == "Brokerage (Taxable)" and not account['isHidden'], self.accounts))
         cost_basis = 0
         for brokerage in brokerages:
-            holdings = asyncio.run(self.mm.get_account_holdings(brokerage['id']))
+            holdings = self.read(ACCOUNTS, self.mm.get_account_holdings, brokerage['id'])
             for holding in holdings['portfolio']['aggregateHoldings']['edges']:
                 if holding['node']['security']['type'] != "derivative":
                     cost_basis += holding['node']['basis']
 
         if "Roth Contribution" in self.category_map:
             # Fetch all roth contributions
-            roth_contributions = asyncio.run(self.mm.get_transactions(category_ids = [self.category_map["Roth Contribution"]]))
+            roth_contributions = self.search_transactions(category_ids = [self.category_map["Roth Contribution"]])
 
-            extra_params["Roth Contributions"] = sum([abs(txn["amount"]) for txn in roth_contributions["allTransactions"]["results"]])
+            extra_params["Roth Contributions"] = sum([abs(txn["amount"]) for txn in roth_contributions])
 
         if "Roth Conversion" in self.category_map:
             # Fetch all roth conversions
-            roth_conversions = asyncio.run(self.mm.get_transactions(category_ids = [self.category_map["Roth Conversion"]]))
+            roth_conversions = self.search_transactions(category_ids = [self.category_map["Roth Conversion"]])
 
-            extra_params["Roth Conversions"] = sum([abs(txn["amount"]) for txn in roth_conversions["allTransactions"]["results"]])
+            extra_params["Roth Conversions"] = sum([abs(txn["amount"]) for txn in roth_conversions])
 
         extra_params['Taxable Cost Basis'] = cost_basis
 
+        # only send the values that changed since this login's last successful export
+        state_key = f"balance_export:{self.creds['mm']['email']}:{util.fingerprint(webhook)}"
+        last_export = self.db.get_state(state_key, {})
+        changed_params = {name: value for name, value in extra_params.items() if last_export.get(name) != value}
+        if not changed_params:
+            logger.info("Account balances are unchanged since the last export. Skipping...")
+            return
+
+        logger.info("Exporting %s of %s balances, which changed since the last export", len(changed_params), len(extra_params))
+
         # send the results to the given webhook
         req = PreparedRequest()
-        req.prepare_url(webhook, extra_params)
+        req.prepare_url(webhook, changed_params)
 
-        requests.get(req.url)
+        if requests.get(req.url, timeout=self.deadline.timeout(WEBHOOK_TIMEOUT)).ok:
+            self.db.set_state(state_key, extra_params)
 
     def handle_auto_splits(self, auto_splits):
         if auto_splits is None or len(auto_splits) == 0:
@@ -250,73 +508,97 @@ class MonarchMoneyHelper:
 
         logger.info("Handling auto-splits")
 
-        today = date.today()
-        start_of_last_month = (today - timedelta(days=today.day)).replace(day=1)
-        end_of_last_month = today - timedelta(days=today.day)
-
-        self.handle_auto_splits_for_dates(auto_splits, start_of_last_month, end_of_last_month)
-
-        start_of_this_month = today.replace(day=1)
-        next_month_sometime = today.replace(day=28) + timedelta(days=4)
-        end_of_this_month = next_month_sometime - timedelta(days=next_month_sometime.day)
-
-        self.handle_auto_splits_for_dates(auto_splits, start_of_this_month, end_of_this_month)
-
-    def handle_auto_splits_for_dates(self, auto_splits, start_date, end_date):
+        # one budget fetch for every month, the same one auto_splits_fingerprint makes, so
+        # it's usually served by the read cache
+        date_ranges = auto_split_date_ranges()
         budgets = self.get_budgets(
-            start_date = start_date.strftime("%Y-%m-%d"),
-            end_date = end_date.strftime("%Y-%m-%d"))
-
+            start_date = date_ranges[0][0].strftime("%Y-%m-%d"),
+            end_date = date_ranges[-1][1].strftime("%Y-%m-%d"))
+
+        for start_date, end_date in date_ranges:
+            self.handle_auto_splits_for_dates(auto_splits, budgets, start_date, end_date)
+
+    # Summarizes everything auto-splits depend on: the config, the months being split, the
+    # ID and last update of every transaction in those months (so new, posted, edited and
+    # deleted transactions all count), and the budgets that budget-directed splits use. This
+    # costs a request per 500 transactions and one for budgets, instead of a search per
+    # auto-split.
+    def auto_splits_fingerprint(self, auto_splits):
+        date_ranges = auto_split_date_ranges()
+        start_date = date_ranges[0][0].strftime("%Y-%m-%d")
+        end_date = date_ranges[-1][1].strftime("%Y-%m-%d")
+
+        budget_directed_category_ids = {self.category_map.get(split['category']) for auto_split in auto_splits for split in auto_split['splits'] if split.get('budget_directed')}
+        budgets = self.get_budgets(start_date=start_date, end_date=end_date) if budget_directed_category_ids else []
+
+        return {
+            "auto_splits": auto_splits,
+            "date_ranges": date_ranges,
+            "transactions": util.fingerprint(sorted((txn['id'], txn['updatedAt']) for txn in self.iter_transactions(start_date=start_date, end_date=end_date))),
+            "budgets": [[amount['plannedCashFlowAmount'] for amount in budget['monthlyAmounts']] for budget in budgets if budget['category']['id'] in budget_directed_category_ids]
+        }
+
+    def handle_auto_splits_for_dates(self, auto_splits, budgets, start_date, end_date):
         for auto_split in auto_splits:
-            txns = self.search_transactions(
+            self.deadline.check()
+
+            txns = records.transaction_records(self.search_transactions(
                 search = auto_split['description'],
                 start_date = start_date.strftime("%Y-%m-%d"),
                 end_date = end_date.strftime("%Y-%m-%d"),
-                is_split = False)
+                is_split = False))
 
+            # amounts are compared and split in cents
             def handle_txn_in_auto_split(txn):
                 for condition in auto_split['conditions']:
+                    condition_amount = abs(records.to_cents(condition['amount']))
                     match condition['rule']:
-                        case "greaterThan"          if abs(txn['amount']) <= abs(condition['amount']):
+                        case "greaterThan"          if abs(txn.amount) <= condition_amount:
                             return
-                        case "greaterThanOrEqualTo" if abs(txn['amount']) <  abs(condition['amount']):
+                        case "greaterThanOrEqualTo" if abs(txn.amount) <  condition_amount:
                             return
-                        case "lessThan"             if abs(txn['amount']) >= abs(condition['amount']):
+                        case "lessThan"             if abs(txn.amount) >= condition_amount:
                             return
-                        case "lessThanOrEqualTo"    if abs(txn['amount']) >  abs(condition['amount']):
+                        case "lessThanOrEqualTo"    if abs(txn.amount) >  condition_amount:
                             return
-                        case "equals"               if abs(txn['amount']) != abs(condition['amount']):
+                        case "equals"               if abs(txn.amount) != condition_amount:
                             return
 
-                logger.info(f"Handling auto-split {auto_split}")
+                logger.info("Handling auto-split %s", auto_split)
 
-                credit_debit_modifier = -1 if txn['amount'] < 0 else 1
+                credit_debit_modifier = -1 if txn.amount < 0 else 1
                 splits = []
+                remainder = txn.amount
                 for split in auto_split['splits']:
                     if 'budget_directed' in split and split['budget_directed']:
                         budget = next(budget for budget in budgets if budget['category']['id'] == self.category_map[split['category']])
-                        amount = abs(budget['monthlyAmounts'][0]['plannedCashFlowAmount'])
+                        monthly_amount = next(amount for amount in budget['monthlyAmounts'] if amount['month'] == start_date.strftime("%Y-%m-%d"))
+                        amount = abs(records.to_cents(monthly_amount['plannedCashFlowAmount']))
                     else:
-                        amount = abs(split['amount'])
+                        amount = abs(records.to_cents(split['amount']))
 
                     splits.append({
                             "merchantName": split['description'],
-                            "amount": credit_debit_modifier * amount,
+                            "amount": records.to_float(credit_debit_modifier * amount),
                             "categoryId": self.category_map[split['category']]
                         })
+                    remainder -= credit_debit_modifier * amount
 
-                remainder = txn['amount'] - sum([split['amount'] for split in splits])
                 splits.append({
-                        "merchantName": txn['merchant']['name'],
-                        "amount": remainder,
-                        "categoryId": txn['category']['id']
+                        "merchantName": txn.merchant,
+                        "amount": records.to_float(remainder),
+                        "categoryId": txn.category_id
                     })
 
-                logger.info(f"Splitting ${txn['amount']} transaction for {txn['merchant']['name']} into sections {splits}")
+                logger.info("Splitting $%s transaction for %s into sections %s", records.to_decimal(txn.amount), txn.merchant, splits)
 
-                res = asyncio.run(self.mm.update_transaction_splits(txn['id'], splits))
+                res = self.write([TRANSACTIONS], self.mm.update_transaction_splits, txn.id, splits)
 
-                logger.info(f"Split successful: {res}")
+                logger.info("Split successful")
+                logger.debug("Split result: %s", res)
+
+                if self.mirror:
+                    self.mirror.discard([txn.id])
 
             for txn in txns:
                 handle_txn_in_auto_split(txn)
@@ -332,38 +614,55 @@ class MonarchMoneyHelper:
             parent_account = partner_account_mapping['parent_account']
 
             logger.info(f"Syncing the balance of \"{child_account}\" to the tracked account \"{parent_account}\"")
-            parent_account_history = asyncio.run(self.mm.get_account_history(self.account_map[parent_account]))
 
-            yesterday_balance = next(snapshot['signedBalance'] for snapshot in parent_account_history if snapshot['date'] == yesterday.strftime("%Y-%m-%d"))
-            today_balance = next(snapshot['signedBalance'] for snapshot in parent_account_history if snapshot['date'] == today.strftime("%Y-%m-%d"))
+            # today's balance was recorded by this run, and yesterday's by the last run
+            # yesterday, if there was one. Otherwise, both come from the account history.
+            yesterday_balance = self.db.get_account_balance(self.account_map[parent_account], yesterday)
+            if yesterday_balance is not None:
+                today_balance = self.db.get_account_balance(self.account_map[parent_account], today)
+            else:
+                parent_account_history = self.read(ACCOUNTS, self.mm.get_account_history, self.account_map[parent_account])
+
+                yesterday_balance = next(snapshot['signedBalance'] for snapshot in parent_account_history if snapshot['date'] == yesterday.strftime("%Y-%m-%d"))
+                today_balance = next(snapshot['signedBalance'] for snapshot in parent_account_history if snapshot['date'] == today.strftime("%Y-%m-%d"))
 
             difference = today_balance - yesterday_balance
 
             if difference != 0:
                 logger.info(f"Difference found between yesterday and today: ${difference:.2f}")
 
-                child_account_history = asyncio.run(self.mm.get_account_history(self.account_map[child_account]))
-                child_balance_yesterday = next(snapshot['signedBalance'] for snapshot in child_account_history if snapshot['date'] == yesterday.strftime("%Y-%m-%d"))
+                child_balance_yesterday = self.db.get_account_balance(self.account_map[child_account], yesterday)
+                if child_balance_yesterday is None:
+                    child_account_history = self.read(ACCOUNTS, self.mm.get_account_history, self.account_map[child_account])
+                    child_balance_yesterday = next(snapshot['signedBalance'] for snapshot in child_account_history if snapshot['date'] == yesterday.strftime("%Y-%m-%d"))
 
                 if (yesterday_balance >= 0) != (child_balance_yesterday >= 0):
                     logger.warn(f"The parent and child account balances are signed differently; results/logging may be misleading")
 
                 new_child_account_balance = child_balance_yesterday * (1 + (difference / yesterday_balance))
 
-                child_account_txns_today = asyncio.run(self.mm.get_transactions(
+                child_account_txns_today = self.search_transactions(
                     account_ids=[str(self.account_map[child_account])],
                     start_date=today.strftime("%Y-%m-%d"),
-                    end_date=today.strftime("%Y-%m-%d")
-                ))['allTransactions']['results']
+                    end_date=today.strftime("%Y-%m-%d"))
 
                 new_child_account_balance += sum([txn['amount'] for txn in child_account_txns_today])
 
                 logger.info(f"New child account balance: ${new_child_account_balance:.2f}")
 
-                asyncio.run(self.mm.update_account(str(self.account_map[child_account]), account_balance=new_child_account_balance))
+                self.write([ACCOUNTS], self.mm.update_account, str(self.account_map[child_account]), account_balance=new_child_account_balance)
+                self.record_account_balance(child_account, new_child_account_balance)
             else:
                 logger.info(f"No change in tracked account balance found")
 
+    # Records a balance this script set, so it's seen by later stages and tomorrow's run
+    def record_account_balance(self, display_name, balance):
+        for account in self.accounts:
+            if account['displayName'] == display_name:
+                account['currentBalance'] = balance
+
+        self.db.record_account_balances({self.account_map[display_name]: balance}, date.today())
+
     def sync_budget_values_with_external_source(self, external_webhooks):
         for webhook_info in external_webhooks:
             description = webhook_info["description"]
@@ -371,26 +670,36 @@ class MonarchMoneyHelper:
 
             logger.info(f"Syncing budget values with output of webhook: {description}")
 
-            r = requests.get(webhook)
+            r = requests.get(webhook, timeout=self.deadline.timeout(WEBHOOK_TIMEOUT))
 
             if r.status_code == 200:
                 budget_updates = r.json()['data']
 
+                # only apply the budgets when they differ from the last ones applied to this login
+                webhook_key = f"webhook:{self.creds['mm']['email']}:{util.fingerprint(webhook)}"
+                payload_fingerprint = util.fingerprint(budget_updates)
+                last_sync = self.db.get_stage_run(webhook_key)
+                if last_sync and last_sync.fingerprint == payload_fingerprint:
+                    logger.info(f"Budget values are unchanged since they were last synced at {last_sync.completed_at}. Skipping...")
+                    continue
+
                 for budget_update in budget_updates:
                     start_date = datetime.fromisoformat(budget_update['start_date'])
 
                     if budget_update['category_name'] not in self.category_map:
                         logger.error(f"Invalid category found: {budget_update['category_name']}")
 
-                    logger.info(f"Setting budget for date '{start_date.strftime("%Y-%m-%d")}' and category '{self.category_map[budget_update['category_name']]}'")
-                    update_r = asyncio.run(self.mm.set_budget_amount(
+                    logger.info(f"Setting budget for date '{start_date.strftime('%Y-%m-%d')}' and category '{self.category_map[budget_update['category_name']]}'")
+                    update_r = self.write([BUDGETS], self.mm.set_budget_amount,
                         amount = budget_update['amount'],
                         category_id = self.category_map[budget_update['category_name']],
-                        start_date = start_date.strftime("%Y-%m-%d")))
+                        start_date = start_date.strftime("%Y-%m-%d"))
 
                     if update_r == 200:
                         logger.info("Successfully set budget")
 
+                self.db.record_stage_run(webhook_key, payload_fingerprint)
+
 
 
 
@@ -0,0 +1,86 @@
+from decimal import Decimal
+
+from util import money_str_to_decimal
+
+# Compact copies of the Splitwise expenses and Monarch Money transactions the stages work
+# through, made as soon as they're fetched. They keep only the fields the stages use, with
+# amounts in integer cents, rather than holding onto the SDK's objects (with their getters
+# and string amounts) or the nested GraphQL results.
+
+# Amounts may be numbers or strings, including configured amounts like "$1,250.00"
+def to_cents(amount):
+	return int((money_str_to_decimal(str(amount or 0)) * 100).quantize(Decimal(1)))
+
+# e.g. 1250 -> Decimal("12.50")
+def to_decimal(cents):
+	return Decimal(cents).scaleb(-2)
+
+def to_float(cents):
+	return cents / 100
+
+# A user's part in a Splitwise expense
+class Share:
+	__slots__ = ("user_id", "paid", "owed")
+
+	def __init__(self, user_id, paid, owed):
+		self.user_id = user_id
+		self.paid = paid
+		self.owed = owed
+
+	def __repr__(self) -> str:
+		return f"Share(user_id={self.user_id!r}, paid={self.paid!r}, owed={self.owed!r})"
+
+# What one user owes another from a Splitwise expense
+class Repayment:
+	__slots__ = ("from_user_id", "to_user_id", "amount")
+
+	def __init__(self, from_user_id, to_user_id, amount):
+		self.from_user_id = from_user_id
+		self.to_user_id = to_user_id
+		self.amount = amount
+
+	def __repr__(self) -> str:
+		return f"Repayment(from_user_id={self.from_user_id!r}, to_user_id={self.to_user_id!r}, amount={self.amount!r})"
+
+# A Splitwise expense, made from anything with the SDK Expense's getters (including the
+# local store's expenses). `date` and `deleted_at` are Splitwise's own strings.
+class ExpenseRecord:
+	__slots__ = ("id", "description", "date", "deleted_at", "shares", "repayments")
+
+	def __init__(self, expense):
+		self.id = expense.getId()
+		self.description = expense.getDescription() or ""
+		self.date = expense.getDate()
+		self.deleted_at = expense.getDeletedAt()
+		self.shares = tuple(Share(user.getId(), to_cents(user.getPaidShare()), to_cents(user.getOwedShare())) for user in expense.getUsers())
+		self.repayments = tuple(Repayment(debt.getFromUser(), debt.getToUser(), to_cents(debt.getAmount())) for debt in expense.getRepayments())
+
+	# the given user's share, or None if they're not part of the expense
+	def share(self, user_id):
+		return next((share for share in self.shares if share.user_id == user_id), None)
+
+	def __repr__(self) -> str:
+		return f"ExpenseRecord(id={self.id!r}, description={self.description!r}, date={self.date!r}, deleted_at={self.deleted_at!r}, shares={self.shares!r}, repayments={self.repayments!r})"
+
+def expense_records(expenses):
+	for expense in expenses:
+		yield ExpenseRecord(expense)
+
+# A Monarch Money transaction, from the results of MonarchMoney.get_transactions
+class TransactionRecord:
+	__slots__ = ("id", "date", "amount", "merchant", "category_id", "notes")
+
+	def __init__(self, txn):
+		self.id = txn['id']
+		self.date = txn['date']
+		self.amount = to_cents(txn['amount'])
+		self.merchant = txn['merchant']['name'] if txn.get('merchant') else ""
+		self.category_id = txn['category']['id'] if txn.get('category') else None
+		self.notes = txn.get('notes') or ""
+
+	def __repr__(self) -> str:
+		return f"TransactionRecord(id={self.id!r}, date={self.date!r}, amount={self.amount!r}, merchant={self.merchant!r}, category_id={self.category_id!r}, notes={self.notes!r})"
+
+def transaction_records(txns):
+	for txn in txns:
+		yield TransactionRecord(txn)
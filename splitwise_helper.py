@@ -1,74 +1,229 @@
 from splitwise import Splitwise
 from splitwise.expense import Expense
 from splitwise.user import ExpenseUser
-from decimal import Decimal
 from datetime import datetime, timedelta, date
 import time
 import re
 import logging
 import json
+import threading
 
 import util
+import leases
+import records
 
 logger = logging.getLogger(__name__)
 
+# expenses are fetched this many at a time, so only one page of the SDK's expense objects
+# is held while they're converted to records
+EXPENSE_PAGE_SIZE = 50
+
 class CurrentUserExcluded(Exception):
     pass
 
 current_user_excluded_exception = CurrentUserExcluded()
 
+class ExpensesNotProcessed(Exception):
+    pass
+
+# Wraps a Splitwise client so that several profiles using the same Splitwise
+# credentials in one process share a single fetch of each read. Writes pass
+# straight through, and invalidate any cached expense queries.
+class SharedSplitwise:
+	CACHED_READS = ("getCurrentUser", "getFriends", "getExpenses")
+
+	def __init__(self, splitwise):
+		self.splitwise = splitwise
+		self.lock = threading.Lock()
+		self.results = {}
+		self.key_locks = {}
+		self.generations = {}
+
+	def __getattr__(self, name):
+		if name in SharedSplitwise.CACHED_READS:
+			return lambda **kwargs: self.cached_read(name, **kwargs)
+		return getattr(self.splitwise, name)
+
+	def cached_read(self, name, **kwargs):
+		key = (name, tuple(sorted((k, str(v)) for k, v in kwargs.items())))
+
+		with self.lock:
+			key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+		# only one caller fetches a given key; the rest wait for its result
+		with key_lock:
+			with self.lock:
+				if key in self.results:
+					logger.debug(f"Using shared Splitwise result for {name}")
+					return self.results[key]
+				generation = self.generations.get(name, 0)
+
+			result = getattr(self.splitwise, name)(**kwargs)
+
+			# a result fetched while another profile's write invalidated it may be from
+			# before the write, so it isn't kept
+			with self.lock:
+				if self.generations.get(name, 0) == generation:
+					self.results[key] = result
+			return result
+
+	def createExpense(self, expense):
+		result = self.splitwise.createExpense(expense)
+
+		with self.lock:
+			self.generations["getExpenses"] = self.generations.get("getExpenses", 0) + 1
+			for key in [key for key in self.results if key[0] == "getExpenses"]:
+				del self.results[key]
+
+		return result
+
 class SplitwiseHelper:
-	def __init__(self, creds, budgeting_app, shorthand_json_path, user_id_to_name_json_path, custom_user_identifier, db):
-		self.budgeting_app = budgeting_app
+	# `budgeting_app` may be a util.LazyValue, so it's only built (and logged in to) once a
+	# transaction is added or searched for
+	def __init__(self, creds, budgeting_app, shorthand_json_path, user_id_to_name_json_path, custom_user_identifier, db, splitwise_client=None, now=None, store=False, deadline=None):
+		self.budgeting_app_value = budgeting_app if isinstance(budgeting_app, util.LazyValue) else util.LazyValue(lambda: budgeting_app)
 		self.custom_user_identifier = custom_user_identifier
 
-		self.splitwise = Splitwise(creds['splitwise']['consumer_key'],creds['splitwise']['secret_key'],api_key=creds['splitwise']['api_key'])
+		# a shared client may be supplied when several profiles run in one process
+		self.splitwise = splitwise_client or Splitwise(creds['splitwise']['consumer_key'],creds['splitwise']['secret_key'],api_key=creds['splitwise']['api_key'])
+		self.now = now or datetime.now()
+
+		# the Splitwise SDK doesn't support timeouts, so the deadline is checked before each request
+		self.deadline = deadline or util.Deadline()
+
+		# the current user and friends are fetched when first needed, so a run that finds
+		# nothing has changed in Splitwise (see expenses_fingerprint) only makes one request
+		self.current_user = util.LazyValue(self.splitwise.getCurrentUser)
+		self.friends = util.LazyValue(self.splitwise.getFriends)
+		self.probe_state_key = f"splitwise_probe:{util.fingerprint(creds['splitwise']['api_key'])}"
 
-		self.my_user_id = self.splitwise.getCurrentUser().getId()
-		self.my_friends = self.splitwise.getFriends()
 		self.user_id_to_name_overrides = {int(k):v for k,v in json.load(open(user_id_to_name_json_path)).items()} if user_id_to_name_json_path else {}
 		self.shorthands_to_categories = json.load(open(shorthand_json_path))
 		self.db = db
 
+		# expenses are queried from a local store of them, if enabled
+		self.store = None
+		if store:
+			from splitwise_store import SplitwiseStore
+			self.store = util.LazyValue(lambda: SplitwiseStore(db, self.my_user_id, self.splitwise))
+
+	@property
+	def my_user_id(self):
+		return self.current_user.get().getId()
+
+	@property
+	def my_friends(self):
+		return self.friends.get()
+
+	@property
+	def budgeting_app(self):
+		return self.budgeting_app_value.get()
+
+	def add_transaction(self, *args, **kwargs):
+		return self.budgeting_app.add_transaction(*args, **kwargs)
+
+	# Takes the same filters as Splitwise.getExpenses. Queries the local store instead, if enabled.
+	def get_expenses(self, **kwargs):
+		self.deadline.check()
+
+		if self.store:
+			return self.store.get().get_expenses(**kwargs)
+
+		return self.splitwise.getExpenses(**kwargs)
+
+	# Yields the expenses matching the given filters (as for get_expenses) as
+	# records.ExpenseRecords, a page at a time, up to `limit` of them (or all of them)
+	def iter_expense_records(self, limit=None, **kwargs):
+		offset = 0
+		while limit is None or offset < limit:
+			page_size = EXPENSE_PAGE_SIZE if limit is None else min(EXPENSE_PAGE_SIZE, limit - offset)
+			page = self.get_expenses(limit=page_size, offset=offset, **kwargs)
+			yield from records.expense_records(page)
+
+			offset += len(page)
+			if len(page) < page_size:
+				return
+
+	def create_expense(self, expense):
+		self.deadline.check()
+
+		expense, errors = self.splitwise.createExpense(expense)
+
+		if self.store and not errors:
+			self.store.get().record([expense])
+
+		return expense, errors
+
+	# Summarizes whether any Splitwise expense was added, changed or deleted, so the expense
+	# stage can be skipped when none were. This asks Splitwise for an expense updated after
+	# the newest update seen so far, in a single request, and moves that point forward
+	# whenever one is returned. The shorthands and user identifier are included, so expenses
+	# skipped for an unmapped shorthand or flag are retried once they're set up.
+	def expenses_fingerprint(self, days_to_look_back):
+		self.deadline.check()
+
+		latest_update = self.db.get_state(self.probe_state_key, {}).get("latest_update")
+		expenses = self.splitwise.getExpenses(updated_after=latest_update, limit=1)
+		if expenses and expenses[0].getUpdatedAt() != latest_update:
+			latest_update = expenses[0].getUpdatedAt()
+			self.db.set_state(self.probe_state_key, {"latest_update": latest_update})
+
+		return {
+			"days_to_look_back": days_to_look_back,
+			"latest_update": latest_update,
+			"shorthands": self.shorthands_to_categories,
+			"custom_user_identifier": self.custom_user_identifier
+		}
+
 	# Translates a Splitwise user ID to a name
 	def splitwise_user_id_to_name(self, user_id):
 		if user_id in self.user_id_to_name_overrides:
 			return self.user_id_to_name_overrides[user_id]
 
 		if user_id == self.my_user_id:
-			me = self.splitwise.getCurrentUser()
+			me = self.current_user.get()
 			return "{} {}".format(me.getFirstName(), me.getLastName()).strip()
 
 		for friend in self.my_friends:
 			if friend.getId() == user_id:
 				return "{} {}".format(friend.getFirstName(), friend.getLastName()).strip()
 
-	def process_splitwise_expenses(self, days_to_look_back):
+	# `shard` is an (index, count) pair limiting the expenses processed, so several
+	# processes can split them (see stages.py)
+	def process_splitwise_expenses(self, days_to_look_back, shard=None):
 		logger.info("Starting to process Splitwise expenses, looking back %s days" % days_to_look_back)
 
-		expenses = self.splitwise.getExpenses(updated_after=(datetime.now() - timedelta(days=days_to_look_back)), updated_before=datetime.now(), limit=200)
+		expenses = self.iter_expense_records(limit=200, updated_after=(self.now - timedelta(days=days_to_look_back)), updated_before=self.now)
+		expenses = (expense for expense in expenses if util.in_shard(expense.id, shard))
+
+		# expenses the budgeting app wouldn't add a transaction for (e.g. for an unknown category)
+		unprocessed_ids = set()
 
-		logger.info("%s expenses to process" % len(expenses))
 		for expense in expenses:
+			# each expense's transactions are written as it's processed, so the rest are
+			# processed again next run. The stage is marked stopped, rather than succeeded.
+			if self.deadline.expired():
+				raise util.DeadlineExceeded("Run deadline reached. The remaining Splitwise expenses will be processed next run")
+			leases.check_lease()
+
 			try:
 				# skip if the transaction is deleted
-				if expense.getDeletedAt():
+				if expense.deleted_at:
 					continue
 
-				process_txn_func = self.budgeting_app.add_transaction
+				process_txn_func = self.add_transaction
 
 				charge_modifier_used = False
 
-				description = expense.getDescription()
+				description = expense.description
 				stripped_description = re.sub(r'\b[MUD][A-Z]*:[A-Z0-9]+\b', '', description).strip()
-				
-				try:
-					my_expense_user = next(user for user in expense.getUsers() if user.getId() == self.my_user_id)
-				except StopIteration:
+			
+				my_share = expense.share(self.my_user_id)
+				if my_share is None:
 					# must be a group expense I am not part of
 					continue
 
-				expense_date = datetime.strptime(expense.getDate(), "%Y-%m-%dT%H:%M:%S%z")
+				expense_date = datetime.strptime(expense.date, "%Y-%m-%dT%H:%M:%S%z")
 
 				# first, check for shorthands
 				shorthand_match = re.findall(r'\bM[A-Z]*:[A-Z]+\b', description)
@@ -95,7 +250,7 @@ class SplitwiseHelper:
 						# override the transaction processing function
 						process_txn_func = self.db.schedule_single_transaction
 
-						logger.info(f"Delay modifier found for transaction. Description: {stripped_description}; Days: {delay_days}; New Date: {expense_date}")
+						logger.info("Delay modifier found for transaction. Description: %s; Days: %s; New Date: %s", stripped_description, delay_days, expense_date)
 
 				if shorthand_match and shorthand_match[0].split(":")[1] in self.shorthands_to_categories:
 					# shorthand found
@@ -113,13 +268,14 @@ class SplitwiseHelper:
 								# want to ensure that only the charge component has been added, since
 								# the main component already has been added.
 								charge_modifier_used = True
-								logger.info("Processing Splitwise CHARGE Transaction. Description: {}; Category: {}; Amount: {}".format(stripped_description, category, -Decimal(my_expense_user.getPaidShare())))
+								logger.info("Processing Splitwise CHARGE Transaction. Description: %s; Category: %s; Amount: %s", stripped_description, category, -records.to_decimal(my_share.paid))
 
 								txn_desc = "SW: {}".format(stripped_description)
-								dedupe = "SPLIT:CHARGE{}".format(expense.getId())
-								amount = -Decimal(my_expense_user.getPaidShare())
+								dedupe = "SPLIT:CHARGE{}".format(expense.id)
+								amount = -records.to_decimal(my_share.paid)
 
-								process_txn_func(txn_desc, amount, category, expense_date, dedupe)
+								if process_txn_func(txn_desc, amount, category, expense_date, dedupe) is False:
+									unprocessed_ids.add(expense.id)
 				else:
 					if shorthand_match:
 						logger.error(f"Shorthand found in expense, but there is no category mapped to it! Expense: {description}")
@@ -140,74 +296,85 @@ class SplitwiseHelper:
 								case 'C':
 									if not charge_modifier_used:
 										charge_modifier_used = True
-										logger.info("Processing Splitwise CHARGE Transaction. Description: {}; Category: {}; Amount: {}".format(stripped_description, category, -Decimal(my_expense_user.getPaidShare())))
+										logger.info("Processing Splitwise CHARGE Transaction. Description: %s; Category: %s; Amount: %s", stripped_description, category, -records.to_decimal(my_share.paid))
 
 										txn_desc = "SW: {}".format(stripped_description)
-										dedupe = "SPLIT:CHARGE{}".format(expense.getId())
-										amount = -Decimal(my_expense_user.getPaidShare())
+										dedupe = "SPLIT:CHARGE{}".format(expense.id)
+										amount = -records.to_decimal(my_share.paid)
 
-										process_txn_func(txn_desc, amount, category, expense_date, dedupe)
+										if process_txn_func(txn_desc, amount, category, expense_date, dedupe) is False:
+											unprocessed_ids.add(expense.id)
 
-				amount_owed_to_me = Decimal(my_expense_user.getPaidShare()) - Decimal(my_expense_user.getOwedShare())
+				amount_owed_to_me = records.to_decimal(my_share.paid - my_share.owed)
 				if amount_owed_to_me == 0:
 					continue
 
 				notes_array = []
-				for debt in expense.getRepayments():
-					amount = util.money_str_to_decimal(debt.getAmount())
-					if debt.getToUser() == self.my_user_id:
-						notes_array.append("{} -> Me: {}".format(self.splitwise_user_id_to_name(debt.getFromUser()), amount))
-					elif debt.getFromUser() == self.my_user_id:
-						notes_array.append("Me -> {}: {}".format(self.splitwise_user_id_to_name(debt.getToUser()), amount))
-
-
-				logger.info("Processing Splitwise Transaction. Description: {}; Category: {}; Amount: {}; {}Debts:{}".format(
-					stripped_description, 
-					category, 
-					amount_owed_to_me, 
-					"Extra Charge Transaction Needed: {}; ".format(-Decimal(my_expense_user.getPaidShare())) if charge_modifier_used else "", 
-					notes_array))
-				
-				process_txn_func(
+				for repayment in expense.repayments:
+					amount = records.to_decimal(repayment.amount)
+					if repayment.to_user_id == self.my_user_id:
+						notes_array.append("{} -> Me: {}".format(self.splitwise_user_id_to_name(repayment.from_user_id), amount))
+					elif repayment.from_user_id == self.my_user_id:
+						notes_array.append("Me -> {}: {}".format(self.splitwise_user_id_to_name(repayment.to_user_id), amount))
+
+
+				logger.info("Processing Splitwise Transaction. Description: %s; Category: %s; Amount: %s; %sDebts:%s",
+					stripped_description,
+					category,
+					amount_owed_to_me,
+					"Extra Charge Transaction Needed: {}; ".format(-records.to_decimal(my_share.paid)) if charge_modifier_used else "",
+					notes_array)
+			
+				added = process_txn_func(
 					"SW: {}".format(stripped_description),
 					amount_owed_to_me,
 					category,
 					expense_date,
-					"SPLIT:{}".format(expense.getId()),
+					"SPLIT:{}".format(expense.id),
 					notes="\n".join(notes_array))
+
+				if added is False:
+					unprocessed_ids.add(expense.id)
 			except CurrentUserExcluded:
 				continue
 
+		# fail the stage, so it isn't skipped as unchanged until these expenses are processed
+		if unprocessed_ids:
+			raise ExpensesNotProcessed(f"Transactions could not be added for Splitwise expenses {sorted(unprocessed_ids)}; they'll be retried next run")
+
 	def import_payments_from_budgeting_app(self, rules):
 		logger.info("Processing payments from budgeting app")
 
 		for rule in rules:
 			user_id = rule['user_id']
-			txns = list(filter(lambda txn: all([search not in txn['merchant']['name'] and search not in str(txn['notes']) for search in ["LOANPAYMENT", "LOANINTERESTPAYMENT"]]),
-				self.budgeting_app.search_transactions(search=rule['search_string'], limit=5)))
+			txns = [txn for txn in records.transaction_records(self.budgeting_app.search_transactions(search=rule['search_string'], limit=5))
+				if all(search not in txn.merchant and search not in txn.notes for search in ["LOANPAYMENT", "LOANINTERESTPAYMENT"])]
 
-			logger.info(f"Processing following payments: {txns}")
+			logger.info("Processing %s payments matching \"%s\"", len(txns), rule['search_string'])
+			logger.debug("Payments: %s", txns)
 
 			for txn in txns:
-				expenses = list(filter(lambda e: not e.getDeletedAt(), self.splitwise.getExpenses(
+				expenses = records.expense_records(self.get_expenses(
 					friend_id    = user_id,
-					dated_after  = (date.fromisoformat(txn['date']) - timedelta(days=1)).isoformat(),
-					dated_before = (date.fromisoformat(txn['date']) + timedelta(days=1)).isoformat())))
+					dated_after  = (date.fromisoformat(txn.date) - timedelta(days=1)).isoformat(),
+					dated_before = (date.fromisoformat(txn.date) + timedelta(days=1)).isoformat()))
+
+				if not any(f"B:{txn.id}" in e.description for e in expenses if not e.deleted_at):
+					amount = str(records.to_decimal(txn.amount))
 
-				if not any(f"B:{txn['id']}" in e.getDescription() for e in expenses):
 					expense = Expense()
-					expense.setCost(txn['amount'])
-					expense.setDescription(f"Direct Payment B:{txn['id']}")
-					expense.setDate(txn['date'])
+					expense.setCost(amount)
+					expense.setDescription(f"Direct Payment B:{txn.id}")
+					expense.setDate(txn.date)
 
 					me = ExpenseUser()
 					me.setId(self.my_user_id)
 					me.setPaidShare('0.00')
-					me.setOwedShare(txn['amount'])
+					me.setOwedShare(amount)
 
 					other = ExpenseUser()
 					other.setId(user_id)
-					other.setPaidShare(txn['amount'])
+					other.setPaidShare(amount)
 					other.setOwedShare('0.00')
 
 					users = []
@@ -216,110 +383,121 @@ class SplitwiseHelper:
 
 					expense.setUsers(users)
 
-					logger.info(f"Creating Splitwise payment expense of ${txn['amount']} from {self.splitwise_user_id_to_name(user_id)} ({user_id}) on date {txn['date']}")
+					logger.info(f"Creating Splitwise payment expense of ${amount} from {self.splitwise_user_id_to_name(user_id)} ({user_id}) on date {txn.date}")
 
-					expense, errors = self.splitwise.createExpense(expense)
+					expense, errors = self.create_expense(expense)
 
 					if errors:
 						logger.error(f"Error while creating payment expense: {errors}")
 					else:
 						logger.info(f"Payment expense created")
 
-	# processes personal loan interest charges, based on provided rates in the config
-	def handle_personal_loans(self, loans):
-		logger.info("Processing personal loan interest")
+	# Interest is charged once a month, from each borrower's balance. This only needs the
+	# (shared) friends list, rather than the expense searches for each loan.
+	def personal_loans_fingerprint(self, loans):
 		today = date.today()
 		start_of_prior_month = (today - timedelta(days=today.day)).replace(day=1)
-		start_of_this_month = today.replace(day=1)
-		last_day_of_prior_month = start_of_this_month - timedelta(days=1)
+		loan_user_ids = {loan['user_id'] for loan in loans}
+
+		return {
+			"month": start_of_prior_month,
+			"loans": loans,
+			"balances": {f.getId(): [b.getAmount() for b in f.getBalances()] for f in self.my_friends if f.getId() in loan_user_ids}
+		}
+
+	# processes personal loan interest charges, based on provided rates in the config. Each
+	# month's interest is on the borrower's average daily balance (see loan_ledger.py), and is
+	# charged on the month's last day. Only last month is processed, unless `months` (the first
+	# days of them) are given, e.g. to catch up on months that were missed.
+	def handle_personal_loans(self, loans, months=None):
+		from loan_ledger import LoanLedger
+
+		logger.info("Processing personal loan interest")
+		today = date.today()
+		months = sorted(months or [(today - timedelta(days=today.day)).replace(day=1)])
+		end_of_months = (months[-1].replace(day=28) + timedelta(days=4)).replace(day=1)
 
 		for loan in loans:
 			user_id                     = loan['user_id']
 			rate                        = loan['rate']
-			budget_category             = loan['budget_category']
-			interest_category_shorthand = loan['interest_category_shorthand']
 			interest_free_balance       = loan.get('interest_free_balance', 0)
 
 			logger.info(f"Processing loan for user {self.splitwise_user_id_to_name(user_id)} ({user_id}), with rate of {rate}")
 
-			friend = next(f for f in self.my_friends if f.getId() == user_id)
-
-			expenses = list(filter(lambda e: not e.getDeletedAt(), self.splitwise.getExpenses(
-				friend_id    = user_id,
-				dated_after  = start_of_prior_month.isoformat(),
-				dated_before = start_of_this_month.isoformat())))
-
-			# New charges to other user
-			expenses_i_paid_for = list(filter(lambda e: float(next(u for u in e.getUsers() if u.getId() == self.my_user_id).getPaidShare()) > 0 and not "LOANSTART" in e.getDescription(), expenses))
-			new_charges = sum(float(next(eu.getOwedShare() for eu in e.getUsers() if eu.getId() == user_id)) for e in expenses_i_paid_for)
-
-			# Interest to charge
-			current_total = max(0, sum(float(b.getAmount()) for b in friend.getBalances()) - interest_free_balance)
-			balance_to_accrue = current_total - new_charges
-			interest = max(0, balance_to_accrue * (rate / 12))
-
-			logger.info(f"    Current total: ${current_total}")
-			logger.info(f"    Balance to accrue: ${balance_to_accrue}")
-			logger.info(f"    Interest: ${interest}")
-
-			if not any("Personal Loan Interest" in e.getDescription() or "LOANSTART" in e.getDescription() for e in expenses):
-				if interest > 0:
-					expense = Expense()
-					expense.setCost(interest)
-					if self.custom_user_identifier:
-						# Use the S flag for the current user, to ensure they do not process it.
-						expense.setDescription(f"Personal Loan Interest M:{interest_category_shorthand} U{self.custom_user_identifier}:S")
-					else:
-						expense.setDescription(f"Personal Loan Interest")
-					expense.setDate(last_day_of_prior_month.isoformat())
-
-					me = ExpenseUser()
-					me.setId(self.my_user_id)
-					me.setPaidShare(interest)
-					me.setOwedShare('0.00')
-
-					other = ExpenseUser()
-					other.setId(user_id)
-					other.setPaidShare('0.00')
-					other.setOwedShare(interest)
-
-					users = []
-					users.append(me)
-					users.append(other)
-
-					expense.setUsers(users)
-
-					logger.info(f"Creating interest expense on Splitwise of ${interest} to {self.splitwise_user_id_to_name(user_id)} ({user_id}) on date {last_day_of_prior_month.isoformat()}")
-
-					expense, errors = self.splitwise.createExpense(expense)
-
-					if errors:
-						logger.error(f"Error while creating interest expense: {errors}")
-					else:
-						logger.info(f"Interest expense created")
-
-			# Money coming to me
-			expenses_they_paid_for = list(filter(lambda e: float(next(u for u in e.getUsers() if u.getId() == user_id).getPaidShare()) > 0, expenses))
-			new_payments = sum(float(next(eu.getOwedShare() for eu in e.getUsers() if eu.getId() == self.my_user_id)) for e in expenses_they_paid_for)
-
-			if new_payments > 0 and interest > 0:
-				logger.info(f"Creating loan interest paid transaction on Monarch of ${min(interest, new_payments)} in category \"Interest\" for month {last_day_of_prior_month.isoformat()}")
-
-				self.budgeting_app.add_transaction(
-					f"Personal Loan Interest Paid from {self.splitwise_user_id_to_name(user_id)}",
-					min(interest, new_payments),
-					"Interest",
-					today,
-					f"LOANINTERESTPAYMENT:{last_day_of_prior_month.isoformat()}",
-					notes=f"New Charges: {new_charges}\nNew Payments: {new_payments}\nInterest: {interest}")
-
-			if new_charges - new_payments < 0:
-				logger.info(f"Creating loan payment transaction on Monarch of ${-1 * (new_charges - new_payments)} in category \"{budget_category}\" for month {last_day_of_prior_month.isoformat()}")
-
-				self.budgeting_app.add_transaction(
-					f"Personal Loan Principal Payment from {self.splitwise_user_id_to_name(user_id)}",
-					-1 * (new_charges - new_payments),
-					budget_category,
-					today,
-					f"LOANPAYMENT:{last_day_of_prior_month.isoformat()}",
-					notes=f"New Charges: {new_charges}\nNew Payments: {new_payments}\nInterest: {interest}")
+			# each day's balance depends on the loan's whole history
+			ledger = LoanLedger(self.iter_expense_records(friend_id=user_id, dated_before=end_of_months.isoformat()), self.my_user_id, user_id)
+
+			for statement in ledger.statements(months, rate, interest_free_balance):
+				self.handle_personal_loan_month(loan, statement, today)
+
+	def handle_personal_loan_month(self, loan, statement, today):
+		user_id                     = loan['user_id']
+		budget_category             = loan['budget_category']
+		interest_category_shorthand = loan['interest_category_shorthand']
+
+		last_day_of_month = (statement.month.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+		interest = statement.interest
+		new_charges = statement.charges
+		new_payments = statement.payments
+
+		logger.info(f"    Month: {statement.month.strftime('%Y-%m')}")
+		logger.info(f"    Average daily balance: ${statement.average_balance}")
+		logger.info(f"    Interest: ${interest}")
+
+		if not statement.interest_charged and interest > 0:
+			expense = Expense()
+			expense.setCost(interest)
+			if self.custom_user_identifier:
+				# Use the S flag for the current user, to ensure they do not process it.
+				expense.setDescription(f"Personal Loan Interest M:{interest_category_shorthand} U{self.custom_user_identifier}:S")
+			else:
+				expense.setDescription(f"Personal Loan Interest")
+			expense.setDate(last_day_of_month.isoformat())
+
+			me = ExpenseUser()
+			me.setId(self.my_user_id)
+			me.setPaidShare(interest)
+			me.setOwedShare('0.00')
+
+			other = ExpenseUser()
+			other.setId(user_id)
+			other.setPaidShare('0.00')
+			other.setOwedShare(interest)
+
+			users = []
+			users.append(me)
+			users.append(other)
+
+			expense.setUsers(users)
+
+			logger.info(f"Creating interest expense on Splitwise of ${interest} to {self.splitwise_user_id_to_name(user_id)} ({user_id}) on date {last_day_of_month.isoformat()}")
+
+			expense, errors = self.create_expense(expense)
+
+			if errors:
+				logger.error(f"Error while creating interest expense: {errors}")
+			else:
+				logger.info(f"Interest expense created")
+
+		# Money coming to me
+		if new_payments > 0 and interest > 0:
+			logger.info(f"Creating loan interest paid transaction on Monarch of ${min(interest, new_payments)} in category \"Interest\" for month {last_day_of_month.isoformat()}")
+
+			self.budgeting_app.add_transaction(
+				f"Personal Loan Interest Paid from {self.splitwise_user_id_to_name(user_id)}",
+				min(interest, new_payments),
+				"Interest",
+				today,
+				f"LOANINTERESTPAYMENT:{last_day_of_month.isoformat()}",
+				notes=f"New Charges: {new_charges}\nNew Payments: {new_payments}\nInterest: {interest}")
+
+		if new_charges - new_payments < 0:
+			logger.info(f"Creating loan payment transaction on Monarch of ${-1 * (new_charges - new_payments)} in category \"{budget_category}\" for month {last_day_of_month.isoformat()}")
+
+			self.budgeting_app.add_transaction(
+				f"Personal Loan Principal Payment from {self.splitwise_user_id_to_name(user_id)}",
+				-1 * (new_charges - new_payments),
+				budget_category,
+				today,
+				f"LOANPAYMENT:{last_day_of_month.isoformat()}",
+				notes=f"New Charges: {new_charges}\nNew Payments: {new_payments}\nInterest: {interest}")
@@ -0,0 +1,83 @@
+import logging
+import threading
+
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+SYNC_PAGE_SIZE = 500
+
+# Each sync asks for expenses updated since shortly before the previous sync started,
+# in case Splitwise's clock and ours disagree
+SYNC_OVERLAP = timedelta(minutes=10)
+
+# Splitwise's own format for expense dates and update times, which compares correctly as text
+def to_splitwise_time(value):
+	if isinstance(value, datetime):
+		return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+	return value
+
+# A local copy of the Splitwise expenses visible to one user, stored in the DB, so the
+# Splitwise stages can query it instead of Splitwise.
+#
+# The store is synced before the first query of each run, by fetching only the expenses
+# updated (or deleted) since the last sync. Expenses created by this script are recorded
+# as they're created.
+class SplitwiseStore:
+	def __init__(self, db, owner, splitwise):
+		self.db = db
+		self.owner = owner
+		self.splitwise = splitwise
+		self.state_key = f"splitwise_store:{owner}"
+
+		self.sync_lock = threading.Lock()
+		self.synced = False
+
+	# Takes the same filters as Splitwise.getExpenses, and returns stored expenses with the
+	# same getters as the ones it returns. As with Splitwise, a limit of 0 means no limit.
+	def get_expenses(self, friend_id=None, dated_after=None, dated_before=None, updated_after=None, updated_before=None, limit=None, offset=0):
+		self.ensure_synced()
+		return self.db.get_splitwise_expenses(
+			self.owner,
+			friend_id      = friend_id,
+			dated_after    = to_splitwise_time(dated_after),
+			dated_before   = to_splitwise_time(dated_before),
+			updated_after  = to_splitwise_time(updated_after),
+			updated_before = to_splitwise_time(updated_before),
+			limit          = limit or None,
+			offset         = offset)
+
+	def ensure_synced(self):
+		with self.sync_lock:
+			if not self.synced:
+				self.sync()
+				self.synced = True
+
+	def sync(self):
+		started_at = datetime.now(timezone.utc)
+		state = self.db.get_state(self.state_key)
+
+		if state is None:
+			logger.info("Fully syncing the local store of Splitwise expenses...")
+			updated_after = None
+		else:
+			updated_after = to_splitwise_time(datetime.fromisoformat(state['synced_at']) - SYNC_OVERLAP)
+			logger.info(f"Syncing Splitwise expenses updated after {updated_after} to the local store...")
+
+		expenses = []
+		while True:
+			page = self.splitwise.getExpenses(updated_after=updated_after, limit=SYNC_PAGE_SIZE, offset=len(expenses))
+			expenses += page
+			if len(page) < SYNC_PAGE_SIZE:
+				break
+
+		# committed on its own, as the sync is only made once a run
+		with self.db.unit_of_work(separate=True):
+			self.db.upsert_splitwise_expenses(self.owner, expenses)
+			self.db.set_state(self.state_key, {'synced_at': started_at.isoformat()})
+
+		logger.info(f"Expense store synced: {len(expenses)} new, updated or deleted expenses")
+
+	# Records expenses created by this script, as returned by Splitwise.createExpense
+	def record(self, expenses):
+		self.db.upsert_splitwise_expenses(self.owner, expenses)
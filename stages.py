@@ -0,0 +1,184 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import util
+
+from leases import Lease, LeaseLost
+
+logger = logging.getLogger(__name__)
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+UNCHANGED = "unchanged"
+STOPPED = "stopped"
+LOCKED = "locked"
+
+# A unit of work in an auto-process run.
+#
+# `inputs` and `outputs` name the shared data a stage reads and writes (e.g.
+# "monarch_transactions"). A stage runs after every stage declared before it that
+# writes one of its inputs, and after any stage named in `depends_on`. Stages with no
+# such relationship run concurrently.
+#
+# `fingerprint`, if given, returns a JSON-serializable summary of everything the stage's
+# result depends on. When it matches the fingerprint recorded at the stage's last
+# successful run, the stage is skipped. A stage whose own writes change its fingerprint
+# (e.g. splitting the transactions it summarizes) sets `refingerprint`, so the fingerprint
+# it records is taken again after it runs.
+#
+# A `sharded` stage's work can be split between processes: when running with several
+# shards, `run` is called once per shard with `shard=(index, count)`, and should only
+# handle the items whose ID is `index` modulo `count`.
+class Stage:
+	def __init__(self, name, run, inputs=(), outputs=(), depends_on=(), fingerprint=None, refingerprint=False, sharded=False):
+		self.name = name
+		self.run = run
+		self.inputs = set(inputs)
+		self.outputs = set(outputs)
+		self.depends_on = set(depends_on)
+		self.fingerprint = fingerprint
+		self.refingerprint = refingerprint
+		self.sharded = sharded
+
+	def __repr__(self) -> str:
+		return f"Stage(name={self.name!r}, inputs={self.inputs!r}, outputs={self.outputs!r}, depends_on={self.depends_on!r})"
+
+# Maps each stage's name to the names of the stages that must finish before it starts.
+# Dependencies on stages that aren't part of this run are ignored.
+def resolve_dependencies(stages):
+	names = {stage.name for stage in stages}
+	dependencies = {}
+
+	for i, stage in enumerate(stages):
+		dependencies[stage.name] = stage.depends_on & names
+		for earlier_stage in stages[:i]:
+			if stage.inputs & earlier_stage.outputs:
+				dependencies[stage.name].add(earlier_stage.name)
+
+	return dependencies
+
+# Runs a single stage, skipping it if its fingerprint is unchanged. Stage runs are recorded
+# in the DB under `key`, which includes the profile name when running several profiles.
+# A stage that runs out of time is marked stopped, rather than failed.
+#
+# Processes sharing the DB coordinate through leases: a stage (or, with several shards,
+# each shard of a sharded stage) is only run by the process holding its lease, and a stage
+# another process holds (or takes over while it runs) is marked locked.
+def run_stage(stage, db, key, skip_unchanged, shards=1):
+	try:
+		if stage.sharded and shards > 1:
+			return run_stage_unless_unchanged(stage, db, key, skip_unchanged, lambda: run_stage_shards(stage, db, key, shards))
+
+		with Lease(db, f"stage:{key}") as lease:
+			if not lease.acquired:
+				logger.info(f"Skipping stage \"{stage.name}\", as another process is running it")
+				return LOCKED
+			return run_stage_unless_unchanged(stage, db, key, skip_unchanged, lambda: run_whole_stage(stage))
+	except util.DeadlineExceeded as e:
+		logger.warning(f"Stage \"{stage.name}\" stopped: {e}")
+		return STOPPED
+	except LeaseLost as e:
+		logger.warning(f"Stage \"{stage.name}\" stopped, as another process took it over: {e}")
+		return LOCKED
+
+def run_whole_stage(stage):
+	stage.run()
+	return SUCCEEDED
+
+# Runs each shard not already held by another process. Shards are tried in the same order
+# by every process, so concurrent runs spread out over the shards rather than queueing up.
+#
+# The stage only counts as succeeded (and so records its fingerprint) if this process ran
+# every shard. Otherwise it's marked locked, since the other process might not finish its
+# shards, and the next run has to check them again.
+def run_stage_shards(stage, db, key, shards):
+	ran = 0
+	for index in range(shards):
+		with Lease(db, f"stage:{key}:shard:{index}/{shards}") as lease:
+			if not lease.acquired:
+				logger.info(f"Skipping shard {index + 1}/{shards} of stage \"{stage.name}\", as another process is running it")
+				continue
+
+			logger.info(f"Running shard {index + 1}/{shards} of stage \"{stage.name}\"")
+			stage.run(shard=(index, shards))
+			ran += 1
+
+	return SUCCEEDED if ran == shards else LOCKED
+
+# `run` runs the stage and returns its status. Only a stage that succeeded records its
+# fingerprint.
+def run_stage_unless_unchanged(stage, db, key, skip_unchanged, run):
+	if stage.fingerprint is None:
+		return run()
+
+	fingerprint = util.fingerprint(stage.fingerprint())
+	last_run = db.get_stage_run(key)
+	if skip_unchanged and last_run and last_run.fingerprint == fingerprint:
+		logger.info(f"Skipping stage \"{stage.name}\", as its inputs are unchanged since its last run at {last_run.completed_at}")
+		return UNCHANGED
+
+	status = run()
+	if status == SUCCEEDED:
+		if stage.refingerprint:
+			fingerprint = util.fingerprint(stage.fingerprint())
+		db.record_stage_run(key, fingerprint)
+	return status
+
+# Runs the stages on up to `max_workers` threads, each as soon as its dependencies have
+# finished. A stage that raises is logged and marked failed without stopping the others;
+# the stages depending on it still run, as they did when stages ran one after another.
+# Once the deadline passes, no more stages are started. Sharded stages are split into
+# `shards` shards. Returns a map of stage name to its status.
+def run_stages(stages, max_workers, db, profile=None, skip_unchanged=True, deadline=None, shards=1):
+	deadline = deadline or util.Deadline()
+	dependencies = resolve_dependencies(stages)
+	logger.debug("Stage dependencies: %s", dependencies)
+
+	statuses = {}
+	pending = list(stages)
+	running = {}
+
+	with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+		while pending or running:
+			for stage in list(pending):
+				stage_dependencies = dependencies[stage.name]
+				if not all(dependency in statuses for dependency in stage_dependencies):
+					continue
+
+				if deadline.expired():
+					logger.warning(f"Not starting stage \"{stage.name}\", as the run deadline was reached")
+					pending.remove(stage)
+					statuses[stage.name] = STOPPED
+					continue
+
+				failed_dependencies = [dependency for dependency in stage_dependencies if statuses[dependency] not in (SUCCEEDED, UNCHANGED, LOCKED)]
+				if failed_dependencies:
+					logger.warning(f"Starting stage \"{stage.name}\", even though stages it depends on did not succeed: {failed_dependencies}")
+				else:
+					logger.info(f"Starting stage \"{stage.name}\"")
+
+				pending.remove(stage)
+				key = f"{profile}:{stage.name}" if profile else stage.name
+				running[executor.submit(run_stage, stage, db, key, skip_unchanged, shards)] = stage
+
+			if not running:
+				# only possible if the dependencies form a cycle
+				for stage in pending:
+					logger.error(f"Skipping stage \"{stage.name}\", as its dependencies can never be met")
+					statuses[stage.name] = SKIPPED
+				break
+
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				stage = running.pop(future)
+				try:
+					statuses[stage.name] = future.result()
+					if statuses[stage.name] not in (STOPPED, LOCKED):
+						logger.info(f"Stage \"{stage.name}\" complete")
+				except (Exception, SystemExit):
+					logger.exception(f"Stage \"{stage.name}\" failed")
+					statuses[stage.name] = FAILED
+
+	return statuses
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules live at the top of the repo, rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
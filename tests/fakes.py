@@ -0,0 +1,81 @@
+from splitwise.expense import Expense
+
+# Builds a Splitwise SDK Expense between me (user 1) and a friend (user 2), where `paid`
+# and `owed` are each user's shares, as strings like "30.00"
+def sdk_expense(id, description, paid=("30.00", "0.00"), owed=("15.00", "15.00"), date="2026-10-01T12:00:00Z", deleted_at=None):
+	users = [{
+		"user": {"id": user_id, "first_name": f"User {user_id}", "last_name": "", "picture": {"medium": None}},
+		"user_id": user_id,
+		"paid_share": paid[i],
+		"owed_share": owed[i],
+		"net_balance": str(float(paid[i]) - float(owed[i]))
+	} for i, user_id in enumerate([1, 2])]
+
+	repayments = []
+	for i, user_id in enumerate([1, 2]):
+		balance = float(paid[i]) - float(owed[i])
+		if balance > 0:
+			repayments.append({"from": 3 - user_id, "to": user_id, "amount": f"{balance:.2f}"})
+
+	return Expense({
+		"id": id, "description": description, "cost": f"{float(paid[0]) + float(paid[1]):.2f}", "date": date,
+		"created_at": date, "updated_at": date, "deleted_at": deleted_at, "currency_code": "USD",
+		"users": users, "repayments": repayments,
+		"created_by": users[0]["user"], "updated_by": None, "deleted_by": None,
+		"category": {"id": 1, "name": "General"}, "receipt": {"large": None, "original": None},
+		"comments_count": 0, "payment": False, "transaction_confirmed": False, "group_id": None,
+		"friendship_id": 1, "expense_bundle_id": None, "details": None, "creation_method": None,
+		"transaction_method": "offline", "repeat_interval": "never", "repeats": False,
+		"email_reminder": False, "email_reminder_in_advance": -1, "next_repeat": None
+	})
+
+class FakeUser:
+	def __init__(self, id):
+		self.id = id
+
+	def getId(self):
+		return self.id
+
+	def getFirstName(self):
+		return f"User {self.id}"
+
+	def getLastName(self):
+		return ""
+
+# A Splitwise client whose expenses are a fixed list, recording the requests made to it.
+# Alternatively, `expenses` may be a count of expenses, each built when it's requested.
+class FakeSplitwise:
+	def __init__(self, expenses):
+		self.expenses = expenses
+		self.requests = []
+
+	def getCurrentUser(self):
+		self.requests.append("getCurrentUser")
+		return FakeUser(1)
+
+	def getFriends(self):
+		self.requests.append("getFriends")
+		return [FakeUser(2)]
+
+	def getExpenses(self, offset=0, limit=20, **kwargs):
+		self.requests.append("getExpenses")
+
+		if isinstance(self.expenses, int):
+			end = min(self.expenses, offset + limit) if limit else self.expenses
+			return [sdk_expense(id, f"Expense {id} M:MG") for id in range(offset, end)]
+
+		return self.expenses[offset:offset + limit] if limit else self.expenses[offset:]
+
+# Stands in for MonarchMoneyHelper, recording the transactions added to it. add_transaction
+# returns `added`, as MonarchMoneyHelper's does.
+class FakeBudgetingApp:
+	def __init__(self, added=True):
+		self.added = added
+		self.transactions = []
+
+	def add_transaction(self, desc, price, category, date, dedupe, notes=""):
+		self.transactions.append((desc, price, category, dedupe))
+		return self.added
+
+	def search_transactions(self, **kwargs):
+		return []
@@ -0,0 +1,30 @@
+from datetime import date, datetime, time
+
+import pytest
+
+from dateutil import rrule
+
+from forecast import expand_rule
+
+AFTER = datetime(2024, 1, 1)
+UNTIL = date(2028, 1, 1)
+
+def rrule_days(rfc_rule):
+	return [occurrence.date().isoformat() for occurrence in rrule.rrulestr(rfc_rule).between(AFTER, datetime.combine(UNTIL, time.max), inc=True)]
+
+# The array-based expansion should agree with dateutil's for every rule it handles
+@pytest.mark.parametrize("rule", [
+	"FREQ=DAILY;INTERVAL=3",
+	"FREQ=WEEKLY;BYDAY=MO,FR",
+	"FREQ=WEEKLY;INTERVAL=2",
+	"FREQ=MONTHLY;BYMONTHDAY=31",
+	"FREQ=MONTHLY;BYMONTHDAY=1,-1;COUNT=10",
+	"FREQ=YEARLY",
+	"FREQ=YEARLY;BYMONTHDAY=15",
+	"FREQ=YEARLY;INTERVAL=2;BYMONTHDAY=1,-1",
+	"FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=29",
+	"FREQ=MONTHLY;BYDAY=1FR",
+])
+def test_expand_rule_matches_rrule(rule):
+	rfc_rule = f"DTSTART:20240310T000000\nRRULE:{rule};BYHOUR=0;BYMINUTE=0;BYSECOND=0"
+	assert [str(day) for day in expand_rule(rfc_rule, AFTER, UNTIL)] == rrule_days(rfc_rule)
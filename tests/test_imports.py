@@ -0,0 +1,32 @@
+import os
+import sys
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Dependencies that take most of a second to import between them, and that commands
+# which don't need them (like --help) shouldn't pay for
+HEAVY_MODULES = ["monarchmoney", "splitwise", "sqlalchemy", "numpy"]
+
+# Runs mint_wizard.py with the given arguments, and returns which of HEAVY_MODULES it imported
+def heavy_modules_imported(*args):
+	script = "\n".join([
+		"import runpy, sys",
+		f"sys.argv = ['mint_wizard.py', *{list(args)!r}]",
+		"try:",
+		"	runpy.run_path('mint_wizard.py', run_name='__main__')",
+		"except SystemExit:",
+		"	pass",
+		f"print('imported:' + ','.join(module for module in {HEAVY_MODULES!r} if module in sys.modules))"
+	])
+
+	result = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+	imported = result.stdout.splitlines()[-1].removeprefix("imported:")
+	return [module for module in imported.split(",") if module]
+
+def test_help_imports_no_heavy_modules():
+	assert heavy_modules_imported("--help") == []
+
+def test_subcommand_help_imports_no_heavy_modules():
+	assert heavy_modules_imported("auto-process", "--help") == []
+	assert heavy_modules_imported("recurring-txns", "forecast", "--help") == []
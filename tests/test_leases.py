@@ -0,0 +1,64 @@
+import time
+import functools
+
+import pytest
+import stages
+
+from datetime import timedelta
+
+from db import Db
+from leases import Lease, LeaseLost, check_lease, PROCESS_OWNER
+from stages import Stage, run_stages, LOCKED
+
+@pytest.fixture
+def db(tmp_path):
+	return Db(str(tmp_path / "test.db"))
+
+def test_lease_is_exclusive_until_released(db):
+	with Lease(db, "work") as lease:
+		assert lease.acquired
+		assert not db.acquire_lease("work", "another process", timedelta(minutes=5))
+
+	assert db.acquire_lease("work", "another process", timedelta(minutes=5))
+
+def test_expired_lease_can_be_taken(db):
+	assert db.acquire_lease("work", "another process", timedelta(seconds=-1))
+
+	with Lease(db, "work") as lease:
+		assert lease.acquired
+
+def test_lost_lease_stops_work(db):
+	with Lease(db, "work", ttl=timedelta(seconds=0.3)) as lease:
+		check_lease()
+
+		# another process takes the lease over, e.g. after a pause longer than the TTL
+		db.release_lease("work", PROCESS_OWNER)
+		db.acquire_lease("work", "another process", timedelta(minutes=5))
+
+		assert lease.lost.wait(1)
+		with pytest.raises(LeaseLost):
+			check_lease()
+
+	# the other process's lease is left alone
+	assert not db.acquire_lease("work", PROCESS_OWNER, timedelta(minutes=5))
+
+def test_stage_held_elsewhere_is_locked(db):
+	db.acquire_lease("stage:stage", "another process", timedelta(minutes=5))
+	runs = []
+
+	assert run_stages([Stage("stage", lambda: runs.append(1))], 1, db) == {"stage": LOCKED}
+	assert runs == []
+
+def test_stage_whose_lease_is_lost_is_locked(db, monkeypatch):
+	monkeypatch.setattr(stages, "Lease", functools.partial(Lease, ttl=timedelta(seconds=0.3)))
+
+	def run():
+		db.release_lease("stage:stage", PROCESS_OWNER)
+		db.acquire_lease("stage:stage", "another process", timedelta(minutes=5))
+		time.sleep(0.5)
+		check_lease()
+
+	stage = Stage("stage", run, fingerprint=lambda: 1)
+	assert run_stages([stage], 1, db) == {"stage": LOCKED}
+
+	assert db.get_stage_run("stage") is None
@@ -0,0 +1,69 @@
+import json
+import tracemalloc
+
+import pytest
+
+from decimal import Decimal
+
+import records
+
+from db import Db
+from fakes import sdk_expense, FakeSplitwise, FakeBudgetingApp
+from splitwise_helper import SplitwiseHelper, EXPENSE_PAGE_SIZE
+
+EXPENSE_COUNT = 2000
+
+@pytest.mark.parametrize("amount, cents", [
+	("12.50", 1250),
+	("$1,250.00", 125000),
+	("-3.10", -310),
+	(0.1 + 0.2, 30),
+	(None, 0)
+])
+def test_to_cents(amount, cents):
+	assert records.to_cents(amount) == cents
+
+def test_to_decimal():
+	assert records.to_decimal(-1250) == Decimal("-12.50")
+
+def test_expense_record():
+	record = records.ExpenseRecord(sdk_expense(7, "Dinner M:MG", paid=("30.00", "0.00"), owed=("10.00", "20.00")))
+
+	assert (record.id, record.description, record.date, record.deleted_at) == (7, "Dinner M:MG", "2026-10-01T12:00:00Z", None)
+	assert (record.share(1).paid, record.share(1).owed) == (3000, 1000)
+	assert record.share(3) is None
+	assert [(r.from_user_id, r.to_user_id, r.amount) for r in record.repayments] == [(2, 1, 2000)]
+
+def test_transaction_record():
+	record = records.TransactionRecord({"id": "1", "date": "2026-10-01", "amount": -12.3, "merchant": {"name": "Store"}, "category": {"id": "c"}, "notes": None})
+
+	assert (record.id, record.amount, record.merchant, record.category_id, record.notes) == ("1", -1230, "Store", "c", "")
+
+# The bytes traced while `build` runs, per expense: what it holds on to, and its peak
+def traced_bytes(build):
+	tracemalloc.start()
+	try:
+		result = build()
+		current, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+
+	assert len(result) == EXPENSE_COUNT
+	return current / EXPENSE_COUNT, peak / EXPENSE_COUNT
+
+def test_records_take_less_memory_than_sdk_expenses():
+	sdk_bytes, _ = traced_bytes(lambda: [sdk_expense(id, "Dinner M:MG") for id in range(EXPENSE_COUNT)])
+	record_bytes, _ = traced_bytes(lambda: [records.ExpenseRecord(sdk_expense(id, "Dinner M:MG")) for id in range(EXPENSE_COUNT)])
+
+	assert record_bytes * 3 < sdk_bytes
+
+def test_streamed_expenses_only_hold_a_page_of_sdk_expenses(tmp_path):
+	shorthands_path = tmp_path / "shorthands.json"
+	shorthands_path.write_text(json.dumps({}))
+	helper = SplitwiseHelper({"splitwise": {"api_key": "api key"}}, FakeBudgetingApp(), str(shorthands_path), None, None, Db(str(tmp_path / "test.db")), splitwise_client=FakeSplitwise(EXPENSE_COUNT))
+
+	_, streamed_peak = traced_bytes(lambda: list(helper.iter_expense_records(limit=EXPENSE_COUNT)))
+	_, fetched_peak = traced_bytes(lambda: list(records.expense_records(helper.get_expenses(limit=EXPENSE_COUNT))))
+
+	assert streamed_peak * 2 < fetched_peak
+	assert helper.splitwise.requests.count("getExpenses") == EXPENSE_COUNT // EXPENSE_PAGE_SIZE + 1
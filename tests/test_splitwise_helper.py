@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from decimal import Decimal
+
+import util
+
+from db import Db
+from fakes import sdk_expense, FakeSplitwise, FakeBudgetingApp
+from splitwise_helper import SplitwiseHelper, ExpensesNotProcessed
+
+CREDS = {"splitwise": {"consumer_key": "key", "secret_key": "secret", "api_key": "api key"}}
+
+@pytest.fixture
+def shorthands_path(tmp_path):
+	path = tmp_path / "shorthands.json"
+	path.write_text(json.dumps({"MG": "Groceries"}))
+	return str(path)
+
+@pytest.fixture
+def db(tmp_path):
+	return Db(str(tmp_path / "test.db"))
+
+def build_helper(splitwise, budgeting_app, shorthands_path, db):
+	return SplitwiseHelper(CREDS, budgeting_app, shorthands_path, None, None, db, splitwise_client=splitwise)
+
+def test_fingerprint_does_not_build_budgeting_app(shorthands_path, db):
+	def build_budgeting_app():
+		raise AssertionError("the budgeting app was built")
+
+	budgeting_app = util.LazyValue(build_budgeting_app)
+	splitwise = FakeSplitwise([sdk_expense(1, "Dinner M:MG")])
+	helper = build_helper(splitwise, budgeting_app, shorthands_path, db)
+
+	first = helper.expenses_fingerprint(2)
+	assert helper.expenses_fingerprint(2) == first
+	assert splitwise.requests == ["getExpenses", "getExpenses"]
+	assert not budgeting_app.built
+
+def test_expense_adds_transaction(shorthands_path, db):
+	budgeting_app = FakeBudgetingApp()
+	helper = build_helper(FakeSplitwise([sdk_expense(1, "Dinner M:MG")]), budgeting_app, shorthands_path, db)
+
+	helper.process_splitwise_expenses(2)
+
+	assert budgeting_app.transactions == [("SW: Dinner", Decimal("15.00"), "Groceries", "SPLIT:1")]
+
+def test_expense_not_added_fails_the_stage(shorthands_path, db):
+	helper = build_helper(FakeSplitwise([sdk_expense(1, "Dinner M:MG"), sdk_expense(2, "Lunch M:MG")]), FakeBudgetingApp(added=False), shorthands_path, db)
+
+	with pytest.raises(ExpensesNotProcessed):
+		helper.process_splitwise_expenses(2)
@@ -0,0 +1,48 @@
+import pytest
+
+import util
+
+from db import Db
+from stages import Stage, run_stages, SUCCEEDED, UNCHANGED, STOPPED, FAILED
+
+@pytest.fixture
+def db(tmp_path):
+	return Db(str(tmp_path / "test.db"))
+
+def test_dependent_stages_run_in_order(db):
+	order = []
+	stages = [
+		Stage("writer", lambda: order.append("writer"), outputs=["data"]),
+		Stage("reader", lambda: order.append("reader"), inputs=["data"])
+	]
+
+	assert run_stages(stages, 4, db) == {"writer": SUCCEEDED, "reader": SUCCEEDED}
+	assert order == ["writer", "reader"]
+
+def test_unchanged_stage_is_skipped(db):
+	runs = []
+	stage = Stage("stage", lambda: runs.append(1), fingerprint=lambda: {"input": 1})
+
+	assert run_stages([stage], 1, db) == {"stage": SUCCEEDED}
+	assert run_stages([stage], 1, db) == {"stage": UNCHANGED}
+	assert len(runs) == 1
+
+def test_refingerprinted_stage_records_its_own_writes(db):
+	state = {"splits": 0}
+	stage = Stage("stage", lambda: state.update(splits=state["splits"] + 1), fingerprint=lambda: dict(state), refingerprint=True)
+
+	assert run_stages([stage], 1, db) == {"stage": SUCCEEDED}
+	assert run_stages([stage], 1, db) == {"stage": UNCHANGED}
+
+def test_stopped_and_failed_stages_record_no_fingerprint(db):
+	def stop():
+		raise util.DeadlineExceeded("stopped")
+
+	def fail():
+		raise ValueError("failed")
+
+	stages = [Stage("stopped", stop, fingerprint=lambda: 1), Stage("failed", fail, fingerprint=lambda: 1)]
+
+	assert run_stages(stages, 2, db) == {"stopped": STOPPED, "failed": FAILED}
+	assert db.get_stage_run("stopped") is None
+	assert db.get_stage_run("failed") is None
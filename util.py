@@ -1,12 +1,30 @@
-from recurrent.event_parser import RecurringEvent
-from datetime import datetime
-from dateutil import rrule
+from datetime import datetime, timezone
 from decimal import Decimal
+import logging.handlers
+import threading
+import hashlib
+import logging
+import atexit
+import queue
+import gzip
+import json
+import os
 import re
+import shutil
+import time
 
 def money_str_to_decimal(money_str):
 	return Decimal(re.sub(r'[\$,]', '', money_str))
 
+# A stable hash of any JSON-serializable value, for telling whether inputs have changed between runs
+def fingerprint(value):
+	return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+# Whether an item with the given integer ID belongs to a shard, given as an (index, count)
+# pair. Everything belongs to no shard at all.
+def in_shard(id, shard):
+	return shard is None or id % shard[1] == shard[0]
+
 def rrule_for_txn(txn):
 	return normalize_rfc_rule(txn.recurring_event.get_RFC_rrule(), txn.previous_occurrence)
 
@@ -26,6 +44,8 @@ def normalize_rfc_rule(rfc_rule, default_start_date=datetime.now()):
 	return rfc_rule
 
 def str_to_valid_recurring_event(rule):
+	from recurrent.event_parser import RecurringEvent
+
 	r = RecurringEvent()
 	r.parse(rule)
 
@@ -36,4 +56,180 @@ def str_to_valid_recurring_event(rule):
 	if not r.is_recurring:
 		raise ValueError(f"The given recurrence rule is invalid: {rule}")
 
-	return r
\ No newline at end of file
+	return r
+
+# Parses and validates a natural-language recurrence rule, returning its RFC rule and its
+# start, if it has one. Unlike a RecurringEvent these can be pickled, so rules can be parsed
+# in a process pool.
+def parse_recurring_rule(rule):
+	event = str_to_valid_recurring_event(rule)
+	return event.get_RFC_rrule(), event.dtstart
+
+# Parses a month like "2024-01" into the date of its first day
+def str_to_month(month):
+	return datetime.strptime(month, "%Y-%m").date()
+
+# Parses a duration like "10m" or "1h30m" into seconds
+def str_to_seconds(duration):
+	from pytimeparse2 import parse
+
+	seconds = parse(duration)
+	if seconds is None or seconds <= 0:
+		raise ValueError(f"The given duration is invalid: {duration}")
+
+	return seconds
+
+class DeadlineExceeded(Exception):
+	pass
+
+# An overall time budget for a run. Remote calls take their timeouts from what's left of
+# it, and long-running loops check it between items, so they can stop at a point the next
+# run can pick up from. Without a budget, nothing ever expires.
+class Deadline:
+	def __init__(self, seconds=None):
+		self.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+	# the seconds left, or None if there's no budget
+	def remaining(self):
+		if self.expires_at is None:
+			return None
+		return max(0, self.expires_at - time.monotonic())
+
+	def expired(self):
+		return self.remaining() == 0
+
+	def check(self):
+		if self.expired():
+			raise DeadlineExceeded("The run deadline has been reached")
+
+	# The timeout for a single remote call: `default` (if given), cut short by the deadline
+	def timeout(self, default=None):
+		self.check()
+
+		remaining = self.remaining()
+		if remaining is None or default is None:
+			return default if remaining is None else remaining
+		return min(default, remaining)
+
+# Builds a value with `factory` the first time it is asked for. Used for helpers whose
+# construction is expensive (e.g. logging in to a remote service), so that runs which
+# never need them don't pay for them.
+class LazyValue:
+	def __init__(self, factory):
+		self.factory = factory
+		self.lock = threading.Lock()
+		self.value = None
+		self.built = False
+
+	def get(self):
+		with self.lock:
+			if not self.built:
+				self.value = self.factory()
+				self.built = True
+			return self.value
+
+# Remembers the results of remote reads, keyed by a group and the read's arguments, so
+# repeated reads in a run only go to the remote service once. Writes invalidate the groups
+# of data they change. With a `ttl` (in seconds), results are re-fetched once they're that
+# old; otherwise they're kept until invalidated.
+#
+# Results are shared between callers, so they must not be modified.
+class ReadCache:
+	def __init__(self, ttl=None):
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.entries = {}
+		self.generations = {}
+		self.hits = 0
+		self.misses = 0
+
+	# Returns the cached result for `key` (anything JSON-serializable) in `group`, or calls
+	# `fetch` for it. A result fetched while its group was invalidated isn't kept, as it may
+	# be from before the write.
+	def get(self, group, key, fetch):
+		key = fingerprint(key)
+		with self.lock:
+			entry = self.entries.get((group, key))
+			if entry and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+				self.hits += 1
+				return entry[0]
+
+			self.misses += 1
+			generation = self.generations.get(group, 0)
+
+		fetched_at = time.monotonic()
+		value = fetch()
+
+		with self.lock:
+			if self.generations.get(group, 0) == generation:
+				self.entries[(group, key)] = (value, fetched_at)
+
+		return value
+
+	def invalidate(self, *groups):
+		with self.lock:
+			for group in groups:
+				self.generations[group] = self.generations.get(group, 0) + 1
+			self.entries = {key: entry for key, entry in self.entries.items() if key[0] not in groups}
+
+# A TimedRotatingFileHandler that gzips each log file as it's rotated out
+class GzipTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.namer = lambda name: f"{name}.gz"
+		self.rotator = self.gzip_rotator
+
+	@staticmethod
+	def gzip_rotator(source, dest):
+		with open(source, "rb") as source_file, gzip.open(dest, "wb") as dest_file:
+			shutil.copyfileobj(source_file, dest_file)
+		os.remove(source)
+
+# Formats each record as a single line of JSON
+class JsonFormatter(logging.Formatter):
+	def format(self, record):
+		entry = {
+			"time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+			"level": record.levelname,
+			"logger": record.name,
+			"thread": record.threadName,
+			"message": record.getMessage()
+		}
+
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+
+		return json.dumps(entry, default=str)
+
+# Queues records with their messages merged with their arguments, but otherwise
+# unformatted. The arguments can be objects (like DB rows) that change after they're
+# logged, or that can't be read from another thread, so the message is built on the thread
+# that logged it; the rest of the formatting is left to the background thread. Records
+# never leave the process, so they don't need to be made picklable.
+class MessageQueueHandler(logging.handlers.QueueHandler):
+	def prepare(self, record):
+		record.msg = record.getMessage()
+		record.args = None
+		return record
+
+# Moves the root logger's handlers (as set up by logging.ini) behind a queue, so records
+# are formatted and written by a background thread rather than the threads logging them.
+# The queue is drained when the process exits.
+def start_queue_logging(json_logs=False):
+	root_logger = logging.getLogger()
+	handlers = list(root_logger.handlers)
+
+	if json_logs:
+		for handler in handlers:
+			handler.setFormatter(JsonFormatter())
+
+	log_queue = queue.SimpleQueue()
+	for handler in handlers:
+		root_logger.removeHandler(handler)
+	root_logger.addHandler(MessageQueueHandler(log_queue))
+
+	listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+	listener.start()
+	atexit.register(listener.stop)
+
+	return listener